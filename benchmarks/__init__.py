@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of permission checks on a synthetic trust graph.
+
+Run with ``python -m benchmarks.runner``; see ``--help`` for the dataset and
+iteration options.
+"""
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import random
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+
+from trusts import closure, effective, grants
+from trusts.models import Trust, Role, RolePermission, TrustUserPermission
+
+from benchmarks.models import Document, GroupJunction
+
+
+PREFIX = 'bench'
+
+BATCH_SIZE = 500
+
+
+def _sample(rnd, population, low, high):
+    return rnd.sample(population, min(len(population), rnd.randint(low, high)))
+
+
+def get_permissions():
+    """
+    Returns the permissions granted by the dataset, on documents and on
+    groups through junctions.
+    """
+
+    ctypes = [ContentType.objects.get_for_model(Document), ContentType.objects.get_for_model(Group)]
+    return list(Permission.objects.filter(content_type__in=ctypes))
+
+
+@transaction.atomic
+def generate(users=100, trusts=50, groups=20, roles=5, documents=1000, junctions=100, seed=0):
+    """
+    Creates ``users`` users, ``trusts`` trusts, ``groups`` groups, ``roles``
+    roles, ``documents`` Document content and ``junctions`` groups as
+    junction content, with random grants through every branch: trust groups,
+    roles of those groups and trustees. Returns a dict of model name to the
+    number of rows in the database.
+    """
+
+    if Trust.objects.filter(title__startswith='%s-' % PREFIX).exists():
+        raise ValueError('The database already holds a dataset.')
+
+    rnd = random.Random(seed)
+    User = get_user_model()
+    root = Trust.objects.get_root()
+    perms = get_permissions()
+
+    User.objects.bulk_create([User(username='%s-user-%d' % (PREFIX, i)) for i in range(users)],
+        batch_size=BATCH_SIZE)
+    user_objs = list(User.objects.filter(username__startswith='%s-user-' % PREFIX).order_by('pk'))
+    user_ids = [user.pk for user in user_objs]
+
+    Group.objects.bulk_create([Group(name='%s-group-%d' % (PREFIX, i)) for i in range(groups)],
+        batch_size=BATCH_SIZE)
+    group_ids = list(Group.objects.filter(name__startswith='%s-group-' % PREFIX)
+        .order_by('pk').values_list('pk', flat=True))
+
+    Trust.objects.bulk_create([
+        Trust(title='%s-trust-%d' % (PREFIX, i), settlor=rnd.choice(user_objs), trust=root)
+        for i in range(trusts)
+    ], batch_size=BATCH_SIZE)
+    trust_ids = list(Trust.objects.filter(title__startswith='%s-trust-' % PREFIX)
+        .order_by('pk').values_list('pk', flat=True))
+
+    Role.objects.bulk_create([Role(name='%s-role-%d' % (PREFIX, i)) for i in range(roles)],
+        batch_size=BATCH_SIZE)
+    role_ids = list(Role.objects.filter(name__startswith='%s-role-' % PREFIX)
+        .order_by('pk').values_list('pk', flat=True))
+
+    User.groups.through.objects.bulk_create([
+        User.groups.through(user_id=user_id, group_id=group_id)
+        for user_id in user_ids for group_id in _sample(rnd, group_ids, 1, 3)
+    ], batch_size=BATCH_SIZE)
+    Trust.groups.through.objects.bulk_create([
+        Trust.groups.through(trust_id=trust_id, group_id=group_id)
+        for trust_id in trust_ids for group_id in _sample(rnd, group_ids, 1, 3)
+    ], batch_size=BATCH_SIZE)
+    Group.permissions.through.objects.bulk_create([
+        Group.permissions.through(group_id=group_id, permission_id=perm.pk)
+        for group_id in group_ids for perm in _sample(rnd, perms, 0, 2)
+    ], batch_size=BATCH_SIZE)
+    # Roles of the models' Meta are given groups as well
+    Role.groups.through.objects.bulk_create([
+        Role.groups.through(role_id=role_id, group_id=group_id)
+        for role_id in Role.objects.order_by('pk').values_list('pk', flat=True)
+        for group_id in _sample(rnd, group_ids, 1, 2)
+    ], batch_size=BATCH_SIZE)
+    RolePermission.objects.bulk_create([
+        RolePermission(role_id=role_id, permission_id=perm.pk)
+        for role_id in role_ids for perm in _sample(rnd, perms, 1, 3)
+    ], batch_size=BATCH_SIZE)
+    TrustUserPermission.objects.bulk_create([
+        TrustUserPermission(trust_id=trust_id, entity_id=user_id, permission_id=perm.pk)
+        for user_id in user_ids for trust_id in _sample(rnd, trust_ids, 1, 3) for perm in _sample(rnd, perms, 1, 2)
+    ], batch_size=BATCH_SIZE)
+
+    Document.objects.bulk_create([
+        Document(title='%s-document-%d' % (PREFIX, i), trust_id=rnd.choice(trust_ids))
+        for i in range(documents)
+    ], batch_size=BATCH_SIZE)
+
+    Group.objects.bulk_create([Group(name='%s-content-%d' % (PREFIX, i)) for i in range(junctions)],
+        batch_size=BATCH_SIZE)
+    GroupJunction.objects.bulk_create([
+        GroupJunction(content_id=group_id, trust_id=rnd.choice(trust_ids))
+        for group_id in Group.objects.filter(name__startswith='%s-content-' % PREFIX).values_list('pk', flat=True)
+    ], batch_size=BATCH_SIZE)
+
+    # bulk_create() sends no signals to maintain the denormalized tables
+    if grants.is_inherited():
+        closure.rebuild()
+    if effective.is_enabled():
+        effective.rebuild()
+
+    return {model._meta.object_name: model.objects.count() for model in
+        (User, Group, Trust, Role, RolePermission, TrustUserPermission, Document, GroupJunction)}
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from benchmarks import dataset
+
+
+class Command(BaseCommand):
+    help = 'Generate a synthetic dataset of users, groups, roles, trusts, grants and content.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', action='store', dest='users', type=int, default=100,
+            help='Number of users.')
+        parser.add_argument('--trusts', action='store', dest='trusts', type=int, default=50,
+            help='Number of trusts.')
+        parser.add_argument('--groups', action='store', dest='groups', type=int, default=20,
+            help='Number of groups.')
+        parser.add_argument('--roles', action='store', dest='roles', type=int, default=5,
+            help='Number of roles.')
+        parser.add_argument('--documents', action='store', dest='documents', type=int, default=1000,
+            help='Number of Content subclass rows.')
+        parser.add_argument('--junctions', action='store', dest='junctions', type=int, default=100,
+            help='Number of Junction rows.')
+        parser.add_argument('--seed', action='store', dest='seed', type=int, default=0,
+            help='Seed of the random grants.')
+
+    def handle(self, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+
+        try:
+            counts = dataset.generate(**{key: options[key] for key in
+                ('users', 'trusts', 'groups', 'roles', 'documents', 'junctions', 'seed')})
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if self.verbosity >= 1:
+            for name, count in sorted(counts.items()):
+                self.stdout.write('%s: %d' % (name, count))
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the per-call cost of the lookups of the innermost permission check
+loop, memoized and not, ie::
+
+    python -m benchmarks.micro --number 200000
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os
+import sys
+import timeit
+
+
+def get_cases():
+    """
+    Returns a list of ``(name, memoized, unmemoized)`` functions of no
+    argument.
+    """
+
+    from trusts import utils
+    from trusts.models import Content, Trust
+
+    perm = 'trusts.change_trust:own'
+
+    def string_is_content_model():
+        return utils.get_short_model_name(Trust) in Content._contents
+
+    def string_get_content_fieldlookup():
+        return Content._contents.get(utils.get_short_model_name(Trust))
+
+    def string_get_permission_condition_func():
+        return Content._conditions.get(utils.get_short_model_name(Trust), {}).get('own')
+
+    return [
+        ('parse_perm_code', lambda: utils.parse_perm_code(perm), lambda: utils.parse_perm_code.__wrapped__(perm)),
+        ('is_content_model', lambda: Content.is_content_model(Trust), string_is_content_model),
+        ('get_content_fieldlookup', lambda: Content.get_content_fieldlookup(Trust), string_get_content_fieldlookup),
+        ('get_permission_condition_func', lambda: Content.get_permission_condition_func(Trust, 'own'),
+            string_get_permission_condition_func),
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark django-trusts permission lookups.')
+    parser.add_argument('--number', type=int, default=100000, help='Number of calls per measure.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of measures, the best is kept.')
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    import django
+    django.setup()
+
+    print('%-30s %12s %14s %8s' % ('lookup', 'memoized us', 'unmemoized us', 'speedup'))
+    for name, memoized, unmemoized in get_cases():
+        timings = [min(timeit.repeat(func, number=args.number, repeat=args.repeat)) / args.number * 1000000
+            for func in (memoized, unmemoized)]
+        print('%-30s %12.3f %14.3f %7.1fx' % (name, timings[0], timings[1], timings[1] / timings[0]))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.contrib.auth.models import Group
+from django.db import models
+
+from trusts.models import Content, Junction
+
+
+class Document(Content):
+    title = models.CharField(max_length=40, null=False, blank=False)
+
+    class Meta:
+        default_permissions = ('add', 'change', 'delete', 'read')
+        roles = (
+            ('reader', ('read_document', )),
+            ('editor', ('read_document', 'add_document', 'change_document')),
+        )
+
+
+class GroupJunction(Junction):
+    content = models.ForeignKey(Group, unique=True, null=False, blank=False)
+
+    class Meta:
+        content_roles = (
+            ('editor', ('change_group', )),
+        )
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Measures permission checks on a generated dataset, ie::
+
+    python -m benchmarks.runner --users 200 --documents 5000 --iterations 500
+
+Each check runs with an empty per-user cache, so that every iteration pays
+for resolving permissions. Set ``TRUSTS_BENCHMARK_DATABASE`` to a file name
+to keep the SQLite database.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os
+import random
+import sys
+import time
+
+
+SCENARIOS = ('object', 'queryset', 'role', 'junction', 'decorator')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def get_scenarios(rnd, page_size):
+    """
+    Returns a dict of scenario name to a function making the check of an
+    iteration, which takes a user and returns the result.
+    """
+
+    from django.contrib.auth.models import Group
+    from django.core.exceptions import PermissionDenied
+    from django.http import HttpResponse
+    from django.test import RequestFactory
+
+    from trusts.decorators import permission_required
+    from benchmarks.models import Document, GroupJunction
+
+    # Objects are loaded upfront so that checks do not time fetching them
+    documents = list(Document.objects.all())
+    document_ids = [document.pk for document in documents]
+    contents = list(Group.objects.filter(pk__in=GroupJunction.objects.values('content')))
+    factory = RequestFactory()
+
+    @permission_required('benchmarks.read_document', fieldlookups_kwargs={'pk': 'pk'})
+    def view(request, pk):
+        return HttpResponse()
+
+    def check_object(user):
+        return user.has_perm('benchmarks.read_document', rnd.choice(documents))
+
+    def check_queryset(user):
+        return user.has_perm('benchmarks.read_document',
+            Document.objects.filter(pk__in=rnd.sample(document_ids, min(page_size, len(document_ids)))))
+
+    def check_role(user):
+        # Mostly granted by the editor role of the groups
+        return user.has_perm('benchmarks.change_document', rnd.choice(documents))
+
+    def check_junction(user):
+        return user.has_perm('auth.change_group', rnd.choice(contents))
+
+    def check_decorator(user):
+        request = factory.get('/')
+        request.user = user
+        try:
+            view(request, pk=rnd.choice(document_ids))
+        except PermissionDenied:
+            return False
+        return True
+
+    return {
+        'object': check_object,
+        'queryset': check_queryset,
+        'role': check_role,
+        'junction': check_junction,
+        'decorator': check_decorator,
+    }
+
+
+def run(scenario, users, iterations, rnd):
+    """
+    Returns the list of durations, in seconds, and the list of query counts of
+    ``iterations`` checks of a random user.
+    """
+
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    durations, queries = [], []
+    for i in range(iterations):
+        user = rnd.choice(users)
+        user.__dict__.pop('_trust_perm_cache', None)
+
+        with CaptureQueriesContext(connection) as captured:
+            start = time.time()
+            scenario(user)
+            durations.append(time.time() - start)
+        queries.append(len(captured))
+    return durations, queries
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark django-trusts permission checks.')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--trusts', type=int, default=50)
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--roles', type=int, default=5)
+    parser.add_argument('--documents', type=int, default=1000)
+    parser.add_argument('--junctions', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--page-size', dest='page_size', type=int, default=20,
+        help='Number of objects of a checked QuerySet.')
+    parser.add_argument('--scenario', dest='scenarios', action='append', choices=SCENARIOS,
+        help='Scenario to run, all if not given. May be repeated.')
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    import django
+    django.setup()
+
+    from django.contrib.auth import get_user_model
+    from django.core.management import call_command
+
+    call_command('migrate', verbosity=0, interactive=False)
+    call_command('update_roles_permissions', verbosity=0)
+    call_command('generate_trust_dataset', verbosity=0, users=args.users, trusts=args.trusts,
+        groups=args.groups, roles=args.roles, documents=args.documents, junctions=args.junctions,
+        seed=args.seed)
+
+    rnd = random.Random(args.seed)
+    users = list(get_user_model().objects.filter(username__startswith='bench-user-'))
+    scenarios = get_scenarios(rnd, args.page_size)
+
+    print('%-10s %8s %10s %10s %10s %10s' % ('scenario', 'checks', 'p50 ms', 'p90 ms', 'p99 ms', 'queries'))
+    for name in args.scenarios or SCENARIOS:
+        durations, queries = run(scenarios[name], users, args.iterations, rnd)
+        print('%-10s %8d %10.3f %10.3f %10.3f %10.2f' % (name, len(durations),
+            percentile(durations, 50) * 1000, percentile(durations, 90) * 1000,
+            percentile(durations, 99) * 1000, float(sum(queries)) / len(queries)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,33 @@
+import os
+
+SECRET_KEY = 'benchmarks-only-0c2b7f7e4a6e4d0f9a1d'
+
+DEBUG = False
+
+ALLOWED_HOSTS = ['*']
+
+INSTALLED_APPS = (
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'trusts',
+    'benchmarks',
+)
+
+AUTHENTICATION_BACKENDS = (
+    'trusts.backends.TrustModelBackend',
+)
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('TRUSTS_BENCHMARK_DATABASE', ':memory:'),
+    }
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+ROOT_URLCONF = 'tests.urls'
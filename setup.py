@@ -21,7 +21,7 @@ setup(
     author_email='thomasleaf@gmail.com',
     long_description=README,
     url='http://github.com/beedesk/django-trusts',
-    packages=find_packages(exclude=[]),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     test_suite="tests.runtests.runtests",
     include_package_data=True,
     zip_safe=False,
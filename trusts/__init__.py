@@ -4,6 +4,7 @@ from __future__ import unicode_literals
 
 from django.conf import settings
 from django.apps import apps as django_apps
+from django.core.exceptions import ImproperlyConfigured
 
 
 ENTITY_MODEL_NAME = getattr(settings, 'TRUSTS_ENTITY_MODEL',
@@ -38,7 +39,7 @@ def get_group_model():
     Returns the Group model
     """
     try:
-        return django_apps.get_model(GROUP_MODEL)
+        return django_apps.get_model(GROUP_MODEL_NAME)
     except ValueError:
         raise ImproperlyConfigured("TRUSTS_GROUP_MODEL must be of the form 'app_label.model_name'")
     except LookupError:
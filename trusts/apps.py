@@ -9,3 +9,10 @@ class AppConfig(DjangoAppConfig):
     name = 'trusts'
     verbose_name = "Django Trusts Add-in"
     label = 'trusts'
+
+    def ready(self):
+        # Connect the receivers keeping the permission caches up to date
+        import trusts.signals
+        import trusts.closure
+        import trusts.effective
+        import trusts.cache
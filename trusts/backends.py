@@ -1,35 +1,47 @@
 from __future__ import unicode_literals
 
-from django.db.models import F, Q, QuerySet
+import operator
+from functools import reduce
+
+from django.db.models import F, QuerySet
 from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import ModelBackend
 
-from trusts.models import Trust, Content
-from trusts import get_permission_model, utils
+from trusts.models import Trust, Content, EffectivePermission
+from trusts import get_permission_model, bitsets, cache, effective, grants, instrumentation, utils
 
 
 class TrustModelBackendMixin(object):
     perm_model = get_permission_model()
 
-    @staticmethod
-    def _get_perm_code(perm):
-        return '%s.%s' % (
-            perm.content_type.app_label, perm.codename
-        )
-
     @staticmethod
     def _get_trusts(obj):
+        """
+        Returns the pks of the trusts of a content object or QuerySet. They
+        are read from ``trust_id`` when the content model has a trust field.
+        """
+
         if not Content.is_content(obj):
             return []
 
-        trusts = Trust.objects.filter_by_content(obj)
-        if trusts is None:
-            return []
+        is_qs = isinstance(obj, QuerySet)
+        klass = obj.model if is_qs else obj.__class__
+        fieldlookup = Content.get_content_fieldlookup(klass)
 
-        if not hasattr(trusts, '__iter__'):
-            trusts = [trusts]
+        if fieldlookup is not None:
+            if is_qs:
+                fieldlookup = '%s__in' % fieldlookup
+            trust_ids = Trust.objects.filter(**{fieldlookup: obj}).values_list('pk', flat=True)
+            return list(trust_ids.distinct())
 
-        return trusts
+        if not is_qs:
+            return [obj.trust_id]
+        if obj._result_cache is not None:
+            return list(set([o.trust_id for o in obj._result_cache]))
+        if not obj.query.can_filter():
+            # Sliced QuerySet cannot be reordered
+            return list(set(obj.values_list('trust_id', flat=True)))
+        return list(obj.order_by().values_list('trust_id', flat=True).distinct())
 
     @staticmethod
     def _get_class(obj):
@@ -49,8 +61,14 @@ class TrustModelBackendMixin(object):
             return super(TrustModelBackendMixin, self).get_group_permissions(user_obj, obj)
 
         if Content.is_content(obj):
-            filter = self.perm_model.objects.filter
-            return filter(group__trusts__in=self._get_trusts(obj), group__user=user_obj)
+            trust_ids = self._get_trusts(obj)
+            if not len(trust_ids):
+                return set()
+
+            perms = self.perm_model.objects.filter(group__user=user_obj,
+                **{'%s__in' % grants.get_trust_lookup('group__trusts'): trust_ids})
+            return set(['%s.%s' % (app_label, codename) for app_label, codename in
+                perms.values_list('content_type__app_label', 'codename').order_by()])
 
         return []
 
@@ -58,59 +76,213 @@ class TrustModelBackendMixin(object):
         if user_obj.is_anonymous() or obj is None:
             return super(TrustModelBackendMixin, self).get_all_permissions(user_obj, obj)
 
+        trust_ids = self._get_trusts(obj)
+        if len(trust_ids):
+            return bitsets.index.to_codes(self._get_trusts_mask(user_obj, trust_ids))
+        return []
+
+    def _get_trusts_mask(self, user_obj, trust_ids):
+        """
+        Returns the bitmask of the permissions granted to the user on every
+        one of the trusts.
+        """
+
+        perm_cache = self._get_trust_perm_cache(user_obj, trust_ids)
+        return reduce(operator.and_, [perm_cache[pk] for pk in trust_ids])
+
+    def _get_trust_perm_cache(self, user_obj, trust_ids):
+        """
+        Returns the per-user cache of trust pk to permission bitmask, after
+        filling in the trusts missing from it.
+
+        With ``TRUSTS_PRELOAD_PERMISSIONS``, the permissions of the user on
+        all trusts are loaded with a single query on first use instead, and
+        any trust missing from the cache grants nothing.
+        """
+
+        misses = []
         if not hasattr(user_obj, '_trust_perm_cache'):
             setattr(user_obj, '_trust_perm_cache', dict())
+            if cache.is_preloaded():
+                user_obj._trust_perm_cache.update(self._get_trust_perms(user_obj, None))
+                user_obj._trust_perm_cache_complete = True
+                misses = trust_ids
         perm_cache = getattr(user_obj, '_trust_perm_cache')
 
-        trusts = self._get_trusts(obj)
-        if len(trusts):
-            all_perms = []
-            for trust in trusts:
-                if trust.pk not in perm_cache.keys():
-                    trust_perm = set([self._get_perm_code(p) for p in
-                        self.perm_model.objects.filter(
-                            Q(group__trusts=trust, group__user=user_obj) |
-                            Q(roles__groups__trusts=trust, roles__groups__user=user_obj) |
-                            Q(trustentities__trust=trust, trustentities__entity=user_obj)
-                        )
-                        .order_by('group__trusts', 'trustentities__entity')
-                    ])
-
-                    perm_cache[trust.pk] = trust_perm
-                else:
-                    trust_perm = perm_cache[trust.pk]
-
-                all_perms.append(trust_perm)
-            return set.intersection(*all_perms)
-        return []
+        uncached = [pk for pk in trust_ids if pk not in perm_cache]
+        if len(uncached) and getattr(user_obj, '_trust_perm_cache_complete', False):
+            perm_cache.update({pk: 0 for pk in uncached})
+        elif len(uncached):
+            keys = cache.make_keys(user_obj, uncached)
+            perm_cache.update(cache.get_trust_perms(keys))
+
+            misses = [pk for pk in uncached if pk not in perm_cache]
+            if len(misses):
+                trust_perms = self._get_trust_perms(user_obj, misses)
+                cache.set_trust_perms(keys, trust_perms)
+                perm_cache.update(trust_perms)
+
+        instrumentation.record_trusts(trust_ids, misses)
+        return perm_cache
+
+    def _get_trust_perms(self, user_obj, trust_ids):
+        """
+        Returns a dict of trust pk to the bitmask of the permissions granted
+        to the user, resolved for all trusts with a single query. If
+        ``trust_ids`` is None, only the trusts granting a permission are
+        returned.
+        """
+
+        if effective.is_enabled():
+            rows = EffectivePermission.objects.filter(entity=user_obj)
+            if trust_ids is not None:
+                rows = rows.filter(trust__in=trust_ids)
+            rows = rows.values_list('trust', 'permission')
+        else:
+            rows = [row[1:] for row in grants.get_grants([user_obj.pk], trust_ids)]
+
+        trust_perms = {pk: 0 for pk in trust_ids or []}
+        for trust_id, permission_id in rows:
+            trust_perms[trust_id] = trust_perms.get(trust_id, 0) | 1 << permission_id
+        return trust_perms
 
     def permission_condition_met(self, func, user_obj, perm, obj):
-        if isinstance(obj, QuerySet):
+        if isinstance(obj, QuerySet) and obj._result_cache is not None:
+            # Fetched already, ie, by the attach option of permission_required
+            objs = obj
+        elif isinstance(obj, QuerySet):
             objs = obj.all()
-        elif hasattr(trusts, '__iter__'):
+        elif hasattr(obj, '__iter__'):
             objs = obj
         else:
             objs = [obj]
 
         return all([func(user_obj, perm, o) for o in objs])
 
-    def has_perm(self, user_obj, permext, obj=None):
+    def _parse_perm(self, permext, klass):
+        """
+        Returns the permission code without its condition, and the condition
+        function of ``klass`` or None.
+        """
+
         applabel, modelname, action, cond = utils.parse_perm_code(permext)
+        func = None
         if len(cond) != 0:
-            func = Content.get_permission_condition_func(self._get_class(obj), cond)
+            func = Content.get_permission_condition_func(klass, cond)
             if func is None:
                 raise AttributeError('Permission condition code "%s" is not associate with model "%s_%s"' % (cond, applabel, modelname))
 
-        perm = '%s.%s_%s' % (applabel, action, modelname)
-        positive = super(TrustModelBackendMixin, self).has_perm(user_obj=user_obj, perm=perm, obj=obj)
+        return '%s.%s_%s' % (applabel, action, modelname), func
+
+    def has_perm(self, user_obj, permext, obj=None):
+        with instrumentation.checking(self.__class__, user_obj, permext, obj) as check:
+            check.result = self._check_perm(user_obj, permext, obj)
+        return check.result
+
+    def _check_perm(self, user_obj, permext, obj):
+        perm, func = self._parse_perm(permext, self._get_class(obj))
+        positive = self._has_trust_perm(user_obj, perm, obj)
         if positive:
-            if len(cond) == 0:
+            if func is None:
                 return True
 
             if self.permission_condition_met(func, user_obj, perm, obj):
                 return True
         return False
 
+    def _has_trust_perm(self, user_obj, perm, obj):
+        """
+        Tests the bit of the permission in the bitmask of the object's
+        trusts, rather than looking it up in the set of all permission codes.
+        """
+
+        if not user_obj.is_active:
+            return False
+        if user_obj.is_anonymous() or obj is None or not Content.is_content(obj):
+            return super(TrustModelBackendMixin, self).has_perm(user_obj=user_obj, perm=perm, obj=obj)
+
+        trust_ids = self._get_trusts(obj)
+        if not len(trust_ids):
+            return False
+
+        mask = self._get_trusts_mask(user_obj, trust_ids)
+        return mask != 0 and mask & bitsets.index.get_bit(perm) != 0
+
+    @staticmethod
+    def _get_object_trusts(klass, objs):
+        """
+        Returns a list of ``(pk, trust pk)`` of content objects, a QuerySet
+        or a list of instances, with at most one query.
+        """
+
+        fieldlookup = Content.get_content_fieldlookup(klass)
+        if fieldlookup is not None:
+            return list(Trust.objects.filter(**{'%s__in' % fieldlookup: objs})
+                .values_list(fieldlookup, 'pk').order_by().distinct())
+
+        if isinstance(objs, QuerySet):
+            return list(objs.values_list('pk', 'trust_id'))
+        return [(o.pk, o.trust_id) for o in objs]
+
+    def has_perm_many(self, user_obj, permext, objs):
+        """
+        Returns a dict of object pk to whether the user has the permission on
+        that object, for content objects given as a QuerySet or a list of
+        instances of one model.
+
+        Permissions of all the distinct trusts are resolved at once, and a
+        condition is evaluated only on the objects already permitted.
+        """
+
+        with instrumentation.checking(self.__class__, user_obj, permext, objs) as check:
+            check.result = self._check_perm_many(user_obj, permext, objs)
+        return check.result
+
+    def _check_perm_many(self, user_obj, permext, objs):
+
+        if isinstance(objs, QuerySet):
+            klass = objs.model
+        else:
+            objs = list(objs)
+            if not len(objs):
+                return {}
+            klass = objs[0].__class__
+
+        perm, func = self._parse_perm(permext, klass)
+        if func is not None and isinstance(objs, QuerySet):
+            # Conditions are evaluated on instances
+            objs = list(objs)
+
+        if isinstance(objs, QuerySet):
+            pks = None
+        else:
+            pks = [o.pk for o in objs]
+
+        object_trusts = {}
+        checked = user_obj.is_active and not user_obj.is_anonymous() and Content.is_content_model(klass)
+        if checked:
+            for pk, trust_id in self._get_object_trusts(klass, objs):
+                object_trusts.setdefault(pk, []).append(trust_id)
+        if pks is None:
+            if checked and Content.get_content_fieldlookup(klass) is None:
+                pks = object_trusts.keys()
+            else:
+                pks = objs.values_list('pk', flat=True)
+
+        results = {pk: False for pk in pks}
+        if len(object_trusts):
+            trust_ids = set([trust_id for trust_ids in object_trusts.values() for trust_id in trust_ids])
+            perm_cache = self._get_trust_perm_cache(user_obj, trust_ids)
+            bit = bitsets.index.get_bit(perm)
+            for pk, trust_ids in object_trusts.items():
+                results[pk] = all([perm_cache[trust_id] & bit for trust_id in trust_ids])
+
+        if func is not None:
+            for obj in objs:
+                if results[obj.pk]:
+                    results[obj.pk] = bool(func(user_obj, perm, obj))
+        return results
+
 
 class TrustModelBackend(TrustModelBackendMixin, ModelBackend):
     pass
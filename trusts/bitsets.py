@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db.models import signals
+
+from trusts import get_permission_model
+
+
+class PermissionIndex(object):
+    """
+    Maps each permission code to a bit of an int, at the position of the
+    Permission pk, so that a set of permissions is stored as a bitmask and
+    intersected with ``&``.
+
+    The index is loaded with a single query on first use, and reloaded when a
+    code or a bit is missing from it. Codes still missing after a reload are
+    remembered until the index is cleared.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self, **kwargs):
+        self._pks = {}
+        self._codes = {}
+        self._unknown = frozenset()
+
+    def load(self):
+        rows = get_permission_model().objects.values_list('pk', 'content_type__app_label', 'codename')
+        self.update(rows)
+
+    def update(self, rows):
+        """
+        Adds ``(pk, app_label, codename)`` rows to the index.
+        """
+
+        pks, codes, unknown = dict(self._pks), dict(self._codes), set(self._unknown)
+        for pk, app_label, codename in rows:
+            code = '%s.%s' % (app_label, codename)
+            unknown.discard(code)
+            stale = codes.get(pk)
+            if stale is not None and stale != code:
+                pks.pop(stale, None)
+            pks[code] = pk
+            codes[pk] = code
+        self._pks, self._codes, self._unknown = pks, codes, frozenset(unknown)
+
+    def get_bit(self, code):
+        """
+        Returns the bitmask of the permission code, or 0 if it does not name
+        a permission.
+        """
+
+        pk = self._pks.get(code)
+        if pk is None:
+            if code in self._unknown:
+                return 0
+            self.load()
+            pk = self._pks.get(code)
+            if pk is None:
+                self._unknown = self._unknown | frozenset([code])
+                return 0
+        return 1 << pk
+
+    def to_codes(self, mask):
+        """
+        Returns the set of permission codes of a bitmask.
+        """
+
+        pks = []
+        while mask:
+            bit = mask & -mask
+            pks.append(bit.bit_length() - 1)
+            mask ^= bit
+
+        if any([pk not in self._codes for pk in pks]):
+            self.load()
+        return set([self._codes[pk] for pk in pks if pk in self._codes])
+
+
+def to_mask(pks):
+    mask = 0
+    for pk in pks:
+        mask |= 1 << pk
+    return mask
+
+
+index = PermissionIndex()
+
+signals.post_save.connect(index.clear, sender=get_permission_model(), weak=False)
+signals.post_delete.connect(index.clear, sender=get_permission_model(), weak=False)
+signals.post_migrate.connect(index.clear, weak=False)
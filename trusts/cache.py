@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.dispatch import receiver
+
+from trusts import effective, grants
+from trusts.models import EffectivePermission
+from trusts.signals import permissions_changed
+
+
+KEY_PREFIX = 'trusts:permbits'
+GENERATION_KEY_PREFIX = 'trusts:gen'
+# Counts the generation bumps, so that warm() can tell one raced its query
+CHANGES_KEY = 'trusts:changes'
+
+
+def get_cache():
+    """
+    Returns the cache shared across requests for per-trust permission
+    bitmasks, or ``None`` if ``TRUSTS_PERMISSION_CACHE`` does not name a cache
+    alias.
+    """
+
+    alias = getattr(settings, 'TRUSTS_PERMISSION_CACHE', None)
+    if alias is None:
+        return None
+    return caches[alias]
+
+
+def get_timeout():
+    return getattr(settings, 'TRUSTS_PERMISSION_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def is_preloaded():
+    """
+    Returns True if ``TRUSTS_PRELOAD_PERMISSIONS`` is set, ie, the first
+    check of a user loads the permissions of the user on all trusts.
+    """
+
+    return getattr(settings, 'TRUSTS_PRELOAD_PERMISSIONS', False)
+
+
+def make_generation_key(scope, pk=None):
+    if pk is None:
+        return '%s:%s' % (GENERATION_KEY_PREFIX, scope)
+    return '%s:%s:%s' % (GENERATION_KEY_PREFIX, scope, pk)
+
+
+def _initial_generation():
+    # A counter that was evicted must not restart at a value already used
+    return int(time.time() * 1000000)
+
+
+def get_generations(cache, keys):
+    """
+    Returns the current value of each generation counter of ``keys``,
+    creating the missing ones.
+    """
+
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            generation = _initial_generation()
+            if not cache.add(key, generation, timeout=None):
+                generation = cache.get(key, generation)
+            generations[key] = generation
+    return generations
+
+
+def _incr(cache, key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, _initial_generation(), timeout=None)
+
+
+def bump_generations(cache, keys):
+    # Counted before the generations move, see warm()
+    _incr(cache, CHANGES_KEY)
+    for key in keys:
+        _incr(cache, key)
+
+
+def make_keys(user_obj, trust_ids):
+    """
+    Returns a dict of trust pk to the shared cache key of the user's
+    permission bitmask on that trust, or an empty dict if the shared cache is
+    disabled.
+
+    The current generations of the entity, of each trust and the global one
+    are part of the key. Bumping a generation orphans every entry built from
+    it rather than looking the entries up.
+    """
+
+    cache = get_cache()
+    if cache is None:
+        return {}
+
+    entity_key = make_generation_key('entity', user_obj.pk)
+    global_key = make_generation_key('global')
+    trust_keys = {trust_id: make_generation_key('trust', trust_id) for trust_id in trust_ids}
+    generations = get_generations(cache, [entity_key, global_key] + list(trust_keys.values()))
+
+    return {trust_id: '%s:%s:%s:%s.%s.%s' % (KEY_PREFIX, user_obj.pk, trust_id,
+                generations[entity_key], generations[trust_keys[trust_id]], generations[global_key])
+            for trust_id in trust_ids}
+
+
+def get_trust_perms(keys):
+    """
+    Returns a dict of trust pk to permission bitmask for the entries of
+    ``keys``, as returned by ``make_keys()``, found in the shared cache.
+    """
+
+    if not len(keys):
+        return {}
+
+    trust_ids = {key: trust_id for trust_id, key in keys.items()}
+    return {trust_ids[key]: perms for key, perms in get_cache().get_many(trust_ids.keys()).items()}
+
+
+def set_trust_perms(keys, trust_perms):
+    if not len(keys):
+        return
+
+    get_cache().set_many({keys[trust_id]: perms for trust_id, perms in trust_perms.items()},
+        timeout=get_timeout())
+
+
+def warm(users):
+    """
+    Stores in the shared cache the permission bitmasks of the users on every
+    trust granting them a permission, loaded with a single query. Returns the
+    number of entries stored, none if a grant changed meanwhile.
+    """
+
+    if get_cache() is None or not len(users):
+        return 0
+
+    # The generations of the trusts are only known once the grants are
+    # loaded, so any bump from now on drops the entries stored below
+    changes = get_cache().get(CHANGES_KEY)
+
+    entity_ids = [user.pk for user in users]
+    if effective.is_enabled():
+        rows = EffectivePermission.objects.filter(entity__in=entity_ids).values_list('entity', 'trust', 'permission')
+    else:
+        rows = grants.get_grants(entity_ids)
+
+    trust_perms = {}
+    for entity_id, trust_id, permission_id in rows:
+        perms = trust_perms.setdefault(entity_id, {})
+        perms[trust_id] = perms.get(trust_id, 0) | 1 << permission_id
+
+    stored = []
+    for user in users:
+        perms = trust_perms.get(user.pk, {})
+        keys = make_keys(user, perms.keys())
+        set_trust_perms(keys, perms)
+        stored.extend(keys.values())
+
+    if get_cache().get(CHANGES_KEY) != changes:
+        get_cache().delete_many(stored)
+        return 0
+    return len(stored)
+
+
+@receiver(permissions_changed)
+def invalidate_trust_perms(sender, trust_ids=None, entity_ids=None, **kwargs):
+    cache = get_cache()
+    if cache is None:
+        return
+
+    if entity_ids is not None:
+        keys = [make_generation_key('entity', pk) for pk in entity_ids]
+    elif trust_ids is not None:
+        keys = [make_generation_key('trust', pk) for pk in grants.get_descendant_ids(trust_ids)]
+    else:
+        # Roles and groups reach too many entries to look up
+        keys = [make_generation_key('global')]
+    bump_generations(cache, keys)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import transaction
+from django.db.models import signals
+
+from trusts import grants
+from trusts.models import Trust, TrustClosure
+from trusts.signals import permissions_changed
+
+
+CHUNK_SIZE = 500
+
+
+def _get_ancestors(trust):
+    """
+    Returns a list of ``(ancestor pk, depth)`` of the new parent of a trust,
+    at their depth from the trust. The root trust is its own parent.
+    """
+
+    if trust.trust_id == trust.pk:
+        return []
+    return [(ancestor_id, depth + 1) for ancestor_id, depth in
+        TrustClosure.objects.filter(descendant=trust.trust_id).values_list('ancestor', 'depth')]
+
+
+def link(trust):
+    """
+    Adds the closure rows of a new trust.
+    """
+
+    TrustClosure.objects.bulk_create(
+        [TrustClosure(ancestor_id=trust.pk, descendant_id=trust.pk, depth=0)] +
+        [TrustClosure(ancestor_id=ancestor_id, descendant_id=trust.pk, depth=depth)
+            for ancestor_id, depth in _get_ancestors(trust)]
+    )
+
+
+def move(trust):
+    """
+    Moves the closure rows of a trust and of its descendants under the new
+    parent of the trust.
+    """
+
+    subtree = list(TrustClosure.objects.filter(ancestor=trust).values_list('descendant', 'depth'))
+    subtree_ids = [descendant_id for descendant_id, depth in subtree]
+    if trust.trust_id != trust.pk and trust.trust_id in subtree_ids:
+        raise ValueError('Trust %s cannot be moved under its own descendant.' % trust.pk)
+
+    ancestors = _get_ancestors(trust)
+    with transaction.atomic():
+        TrustClosure.objects.filter(descendant__in=subtree_ids).exclude(ancestor__in=subtree_ids).delete()
+        TrustClosure.objects.bulk_create([
+            TrustClosure(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=ancestor_depth + depth)
+            for ancestor_id, ancestor_depth in ancestors for descendant_id, depth in subtree
+        ], batch_size=CHUNK_SIZE)
+    return subtree_ids
+
+
+def rebuild(chunk_size=CHUNK_SIZE):
+    """
+    Recomputes the whole ``TrustClosure`` table from the trust field of all
+    trusts.
+    """
+
+    parents = dict(Trust.objects.values_list('pk', 'trust_id'))
+
+    rows = []
+    for pk in parents:
+        ancestor_id, depth = pk, 0
+        while True:
+            rows.append(TrustClosure(ancestor_id=ancestor_id, descendant_id=pk, depth=depth))
+            if parents[ancestor_id] == ancestor_id or depth >= len(parents):
+                break
+            ancestor_id, depth = parents[ancestor_id], depth + 1
+
+    with transaction.atomic():
+        TrustClosure.objects.all().delete()
+        TrustClosure.objects.bulk_create(rows, batch_size=chunk_size)
+
+
+def trust_saved(sender, instance, created, raw=False, **kwargs):
+    if raw or not grants.is_inherited():
+        return
+
+    if created:
+        link(instance)
+        if instance.trust_id != instance.pk:
+            # Inherits the grants of its ancestors
+            permissions_changed.send(sender=sender, trust_ids=[instance.pk])
+        return
+
+    parent_ids = TrustClosure.objects.filter(descendant=instance, depth=1).values_list('ancestor', flat=True)
+    if list(parent_ids) != ([] if instance.trust_id == instance.pk else [instance.trust_id]):
+        trust_ids = move(instance)
+        if len(trust_ids):
+            permissions_changed.send(sender=sender, trust_ids=trust_ids)
+
+
+signals.post_save.connect(trust_saved, sender=Trust)
@@ -1,16 +1,18 @@
-from functools import wraps
+from functools import reduce, wraps
 
 from django.conf import settings
 from django.contrib.auth import REDIRECT_FIELD_NAME
 from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
 from django.shortcuts import resolve_url
 from django.contrib.contenttypes.models import ContentType
+from django.db.models import Case, Count, IntegerField, Q, Value, When
 from django.utils.decorators import available_attrs
 from django.utils.six.moves.urllib.parse import urlparse
 from django.http import Http404
 from operator import and_, or_
 
 from trusts import utils
+from trusts.models import Content, Trust
 
 
 class P(object):
@@ -61,6 +63,16 @@ class P(object):
 
         return leaves
 
+    def evaluate(self, results):
+        """
+        Returns the value of the expression, given a dict of the ``id()`` of
+        each leaf to its value.
+        """
+
+        if self._operator:
+            return self._operator(self._left_operand.evaluate(results), self._right_operand.evaluate(results))
+        return results[id(self)]
+
     def solve(self, fn):
         if self._operator:
             # Parent node, return result operation
@@ -147,7 +159,7 @@ def _get_permissible_items(perm, request, fieldlookups):
 
         return ctype.model_class().objects.filter(**fieldlookups)
     except ObjectDoesNotExist:
-        raise ValueError('Permission code must be of the form "app_label.action_modelname". Actual: %s' % permext)
+        raise ValueError('Permission code must be of the form "app_label.action_modelname". Actual: %s' % perm)
 
 
 def _resolve_fieldlookups(request, kwargs, fieldlookups_kwargs=None, fieldlookups_getparams=None, fieldlookups_postparams=None, **fieldlookups):
@@ -171,7 +183,116 @@ def _resolve_fieldlookups(request, kwargs, fieldlookups_kwargs=None, fieldlookup
     return resolved_fields or None
 
 
-def _check(perm, request, kwargs, raise_exception, **fieldlookups):
+def _count_permitted(user, items, checks):
+    """
+    Returns a dict of each key of the ``(key, perm, q)`` of ``checks`` to
+    whether the user has ``perm`` on every one of the ``items`` matching ``q``,
+    of which there must be at least one, with a single query. A ``q`` of None
+    matches all the ``items``.
+    """
+
+    if user.is_anonymous() or not user.is_active:
+        return {key: False for key, perm, q in checks}
+    if user.is_superuser:
+        return {key: True for key, perm, q in checks}
+
+    def count(q):
+        if q is None:
+            return Count('pk')
+        return Count(Case(When(q, then=Value(1)), output_field=IntegerField()))
+
+    # Checks on the same lookups share the count of their items
+    aggregates = {}
+    item_aliases = {}
+    for i, (key, perm, q) in enumerate(checks):
+        perm_q = Trust.objects.get_content_permission_q(items.model, user, perm)
+        aggregates['perm_%d' % i] = count(perm_q if q is None else q & perm_q)
+        item_aliases.setdefault(str(q), 'items_%d' % i)
+        aggregates.setdefault(item_aliases[str(q)], count(q))
+    counts = items.order_by().aggregate(**aggregates)
+
+    results = {}
+    for i, (key, perm, q) in enumerate(checks):
+        total = counts[item_aliases[str(q)]]
+        results[key] = total > 0 and counts['perm_%d' % i] == total
+    return results
+
+
+def _has_perms_single_query(user, perms, items):
+    """
+    Returns whether the user has all ``perms`` on every one of the ``items``,
+    of which there must be at least one, with a single query. Falls back to
+    ``user.has_perms()`` for permission conditions and for models that are
+    not content models.
+    """
+
+    if any([':' in perm for perm in perms]) or not Content.is_content_model(items.model):
+        return user.has_perms(perms, items)
+
+    return all(_count_permitted(user, items, [(perm, perm, None) for perm in perms]).values())
+
+
+def _compile(p):
+    """
+    Returns the leaves of ``p`` with the app label and model name of their
+    permission, ie, the part of the check of a P expression not depending on
+    the request.
+    """
+
+    compiled = []
+    for leaf in p.get_leaves():
+        applabel, modelname, action, cond = utils.parse_perm_code(leaf._perm)
+        if not applabel or not modelname:
+            raise ValueError('Permission code must be of the form "app_label.action_modelname". Actual: %s' % leaf._perm)
+        compiled.append((leaf, applabel, modelname))
+    return compiled
+
+
+def _check_compiled(p, compiled, request, kwargs, raise_exception):
+    """
+    Checks the compiled leaves of ``p`` with one query per model: the leaves
+    on a content model are counted together over the union of their lookups,
+    and the tree is then evaluated on the results. Leaves with a permission
+    condition or on other models are checked with ``user.has_perms()``.
+    """
+
+    results = {}
+    groups = {}
+    for leaf, applabel, modelname in compiled:
+        resolved_items = _resolve_fieldlookups(request, kwargs, **leaf._fieldlookups)
+        if resolved_items is None:
+            if raise_exception:
+                raise Http404
+            results[id(leaf)] = False
+        elif ':' in leaf._perm:
+            items = _get_permissible_items(leaf._perm, request, resolved_items)
+            results[id(leaf)] = request.user.has_perms((leaf._perm, ), items)
+        else:
+            groups.setdefault((applabel, modelname), []).append((leaf, Q(**resolved_items)))
+
+    for (applabel, modelname), leaves in groups.items():
+        try:
+            model = ContentType.objects.get_by_natural_key(applabel, modelname).model_class()
+        except ObjectDoesNotExist:
+            raise ValueError('Permission code must be of the form "app_label.action_modelname". Actual: %s' % leaves[0][0]._perm)
+
+        if not Content.is_content_model(model):
+            for leaf, q in leaves:
+                results[id(leaf)] = request.user.has_perms((leaf._perm, ), model._default_manager.filter(q))
+            continue
+
+        items = model._default_manager.filter(reduce(or_, [q for leaf, q in leaves]))
+        results.update(_count_permitted(request.user, items, [(id(leaf), leaf._perm, q) for leaf, q in leaves]))
+
+    if p.evaluate(results):
+        return True
+
+    if raise_exception:
+        raise PermissionDenied
+    return False
+
+
+def _check(perm, request, kwargs, raise_exception, single_query=False, attach=None, **fieldlookups):
     if not isinstance(perm, (list, tuple)):
         perms = (perm, )
     else:
@@ -187,7 +308,20 @@ def _check(perm, request, kwargs, raise_exception, **fieldlookups):
                 raise Http404
             return False
 
-    if request.user.has_perms(perms, items):
+    if attach is not None:
+        # The trusts of fetched objects are read from their trust_id
+        len(items)
+
+    if single_query and items is not None:
+        permitted = _has_perms_single_query(request.user, perms, items)
+    else:
+        permitted = request.user.has_perms(perms, items)
+
+    if permitted:
+        if attach is not None:
+            if not hasattr(request, 'trusts_objects'):
+                request.trusts_objects = {}
+            request.trusts_objects[attach] = items
         return True
 
     # In case the 403 handler should be called raise the exception
@@ -196,23 +330,36 @@ def _check(perm, request, kwargs, raise_exception, **fieldlookups):
     return False
 
 
-def permission_required(perm, raise_exception=True, login_url=None, **fieldlookups):
+def permission_required(perm, raise_exception=True, login_url=None, single_query=False, attach=None, **fieldlookups):
     '''
     Decorator for views that checks whether a user has a particular permission
     enabled, redirecting to the log-in page if necessary.
     If the raise_exception parameter is given the PermissionDenied exception
     is raised.
+    If the single_query parameter is given, the objects looked up are checked
+    with a single query joining their trusts to the user's grants, bypassing
+    the per-user permission cache and other authentication backends. A P
+    expression is then compiled once, and its leaves are checked with one
+    query per model.
+    If the attach parameter is given, the objects looked up for a permission,
+    other than a P expression, are fetched before the check, and set under that key of the
+    ``request.trusts_objects`` dict when it passes.
 
     Adapted from `django/contrib/auth/decorator.py`
     '''
 
+    compiled = _compile(perm) if single_query and isinstance(perm, P) else None
+
     def _check_perms(request, *args, **kwargs):
+        if compiled is not None:
+            return _check_compiled(perm, compiled, request, kwargs, raise_exception)
+
         def _wrapped_check(perm, **fieldlookups):
-            return _check(perm, request, kwargs, raise_exception, **fieldlookups)
+            return _check(perm, request, kwargs, raise_exception, single_query, **fieldlookups)
 
         if isinstance(perm, P):
             return perm.solve(_wrapped_check)
 
-        return _check(perm, request, kwargs, raise_exception, **fieldlookups)
+        return _check(perm, request, kwargs, raise_exception, single_query, attach, **fieldlookups)
 
     return request_passes_test(_check_perms, login_url=login_url)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import transaction
+from django.dispatch import receiver
+
+from trusts import get_entity_model, grants
+from trusts.models import EffectivePermission
+from trusts.signals import permissions_changed, resolve_affected, get_deleted_trust_ids
+
+
+CHUNK_SIZE = 500
+
+
+def is_enabled():
+    """
+    Returns True if ``TRUSTS_EFFECTIVE_PERMISSIONS`` is set, ie, permission
+    checks read the ``EffectivePermission`` table.
+    """
+
+    return getattr(settings, 'TRUSTS_EFFECTIVE_PERMISSIONS', False)
+
+
+def _chunks(pks, chunk_size):
+    pks = list(pks)
+    for i in range(0, len(pks), chunk_size):
+        yield pks[i:i + chunk_size]
+
+
+def refresh(entity_ids, trust_ids=None, chunk_size=CHUNK_SIZE):
+    """
+    Replaces the effective permissions of the entities on the trusts, or on
+    all trusts if ``trust_ids`` is None, with the ones computed from the
+    grants.
+    """
+
+    trust_chunks = [None] if trust_ids is None else list(_chunks(trust_ids, chunk_size))
+    for entity_chunk in _chunks(entity_ids, chunk_size):
+        for trust_chunk in trust_chunks:
+            rows = grants.get_grants(entity_chunk, trust_chunk)
+
+            with transaction.atomic():
+                stale = EffectivePermission.objects.filter(entity__in=entity_chunk)
+                if trust_chunk is not None:
+                    stale = stale.filter(trust__in=trust_chunk)
+                stale.delete()
+
+                EffectivePermission.objects.bulk_create([
+                    EffectivePermission(entity_id=entity_id, trust_id=trust_id, permission_id=permission_id)
+                    for entity_id, trust_id, permission_id in rows
+                ], batch_size=chunk_size)
+
+
+def rebuild(chunk_size=CHUNK_SIZE):
+    """
+    Recomputes the whole ``EffectivePermission`` table, ``chunk_size``
+    entities at a time.
+    """
+
+    entity_ids = get_entity_model()._default_manager.order_by('pk').values_list('pk', flat=True)
+    refresh(entity_ids, chunk_size=chunk_size)
+
+
+@receiver(permissions_changed)
+def refresh_effective_permissions(sender, **kwargs):
+    if not is_enabled():
+        return
+
+    entity_ids, trust_ids = resolve_affected(**kwargs)
+    # Effective permissions on trusts being deleted cascade with them
+    trust_ids = set(trust_ids) - get_deleted_trust_ids()
+    if len(entity_ids) and len(trust_ids):
+        refresh(entity_ids, trust_ids)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import connections
+
+from trusts import get_permission_model
+from trusts.models import TrustClosure
+
+
+def is_inherited():
+    """
+    Returns True if ``TRUSTS_INHERIT_PERMISSIONS`` is set, ie, permissions
+    granted on a trust are also granted on all its descendants.
+    """
+
+    return getattr(settings, 'TRUSTS_INHERIT_PERMISSIONS', False)
+
+
+def get_trust_lookup(lookup):
+    """
+    Returns the lookup of the trusts a grant applies to, from the ``lookup``
+    of the trust it is granted on.
+    """
+
+    if is_inherited():
+        return '%s__closure_descendants__descendant' % lookup
+    return lookup
+
+
+def get_descendant_ids(trust_ids):
+    """
+    Returns the pks of the trusts, and of their descendants if permissions
+    are inherited.
+    """
+
+    trust_ids = set(trust_ids)
+    if is_inherited() and len(trust_ids):
+        trust_ids.update(TrustClosure.objects.filter(ancestor__in=trust_ids).values_list('descendant', flat=True))
+    return trust_ids
+
+
+def execute_union(querysets):
+    """
+    Returns the rows of the UNION of ``values_list()`` QuerySets, executed as
+    a single query.
+    """
+
+    sql, params = [], []
+    for qs in querysets:
+        qs_sql, qs_params = qs.order_by().query.sql_with_params()
+        sql.append(qs_sql)
+        params.extend(qs_params)
+
+    with connections[querysets[0].db].cursor() as cursor:
+        cursor.execute(' UNION '.join(sql), params)
+        return cursor.fetchall()
+
+
+def get_grant_querysets(entity_ids, trust_ids=None, fields=('pk',)):
+    """
+    Returns the ``values_list()`` QuerySets of the permissions granted to the
+    entities on the trusts, or on any trust if ``trust_ids`` is None, one for
+    each way of granting: through a group, through a role of a group and
+    directly. Rows are ``(entity_id, trust_id)`` followed by Permission
+    ``fields``, with a row for each descendant if permissions are inherited.
+    """
+
+    branches = (
+        ('group__user', 'group__trusts'),
+        ('roles__groups__user', 'roles__groups__trusts'),
+        ('trustentities__entity', 'trustentities__trust'),
+    )
+
+    querysets = []
+    for entity_lookup, trust_lookup in branches:
+        trust_lookup = get_trust_lookup(trust_lookup)
+        filters = {'%s__in' % entity_lookup: entity_ids}
+        if trust_ids is None:
+            filters['%s__isnull' % trust_lookup] = False
+        else:
+            filters['%s__in' % trust_lookup] = trust_ids
+
+        querysets.append(get_permission_model().objects.filter(**filters)
+            .values_list(entity_lookup, trust_lookup, *fields))
+    return querysets
+
+
+def get_grants(entity_ids, trust_ids=None, fields=('pk',)):
+    """
+    Returns the distinct rows of ``get_grant_querysets()`` with one query.
+    """
+
+    if not len(entity_ids) or (trust_ids is not None and not len(trust_ids)):
+        return []
+    return execute_union(get_grant_querysets(entity_ids, trust_ids, fields))
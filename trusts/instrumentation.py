@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+
+from trusts.signals import permission_checked
+
+
+_local = threading.local()
+
+
+class Check(object):
+    """
+    The outcome of a permission check, filled in while it runs.
+    """
+
+    def __init__(self):
+        self.result = None
+        self.hits = []
+        self.misses = []
+
+
+@contextmanager
+def checking(sender, user, perm, obj):
+    """
+    Records the trusts resolved by a permission check run in the block, and
+    sends ``permission_checked`` at its end. Only the ``result`` of the
+    yielded ``Check`` is kept if the signal has no receivers.
+    """
+
+    check = Check()
+    if not permission_checked.has_listeners() or getattr(_local, 'check', None) is not None:
+        yield check
+        return
+
+    queries = len(connection.queries_log) if connection.queries_logged else None
+    start = time.time()
+    _local.check = check
+    try:
+        yield check
+    finally:
+        _local.check = None
+
+    duration = time.time() - start
+    if queries is not None:
+        queries = len(connection.queries_log) - queries
+    permission_checked.send(sender=sender, user=user, perm=perm, obj=obj, result=check.result,
+            hits=check.hits, misses=check.misses, queries=queries, duration=duration)
+
+
+def record_trusts(trust_ids, misses):
+    """
+    Adds the pks of the trusts resolved, ``trust_ids``, to the running check,
+    as misses if they are in ``misses``, ie, loaded from the database, or else
+    as hits.
+    """
+
+    check = getattr(_local, 'check', None)
+    if check is not None:
+        misses = set(misses)
+        check.hits.extend([pk for pk in trust_ids if pk not in misses])
+        check.misses.extend([pk for pk in trust_ids if pk in misses])
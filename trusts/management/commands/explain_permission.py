@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import time
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from trusts import get_entity_model, effective, grants
+from trusts.backends import TrustModelBackend
+from trusts.models import EffectivePermission
+
+
+BRANCHES = ('group', 'role', 'trustee')
+
+
+def get_user(value):
+    User = get_entity_model()
+    try:
+        return User._default_manager.get_by_natural_key(value)
+    except User.DoesNotExist:
+        pass
+    try:
+        return User._default_manager.get(pk=value)
+    except (User.DoesNotExist, ValueError):
+        raise CommandError('User "%s" does not exist.' % value)
+
+
+def get_object(model_name, pk):
+    try:
+        model = apps.get_model(model_name)
+    except (LookupError, ValueError):
+        raise CommandError('Model "%s" does not exist.' % model_name)
+    try:
+        return model._default_manager.get(pk=pk)
+    except (model.DoesNotExist, ValueError):
+        raise CommandError('%s "%s" does not exist.' % (model.__name__, pk))
+
+
+def get_granting_branches(user, perm, trust_ids):
+    """
+    Returns a dict of trust pk to the list of ways ``perm`` is granted to the
+    user on the trust: through a ``group``, through a ``role`` of a group or
+    directly to the ``trustee``.
+    """
+
+    applabel, codename = perm.split('.', 1)
+    querysets = grants.get_grant_querysets([user.pk], trust_ids, fields=('content_type__app_label', 'codename'))
+
+    branches = {pk: [] for pk in trust_ids}
+    for branch, qs in zip(BRANCHES, querysets):
+        for entity_id, trust_id, row_applabel, row_codename in qs.distinct():
+            if (row_applabel, row_codename) == (applabel, codename) and branch not in branches[trust_id]:
+                branches[trust_id].append(branch)
+    return branches
+
+
+class Command(BaseCommand):
+    help = 'Explain whether a user has a permission on an object, and which grants and queries decide it.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('user', help='Username or pk of the user.')
+        parser.add_argument('perm', help='Permission code, ie, "app_label.change_model:condition".')
+        parser.add_argument('model', help='Model of the object, ie, "app_label.Model".')
+        parser.add_argument('pk', help='Pk of the object.')
+
+    def handle(self, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+
+        user = get_user(options['user'])
+        obj = get_object(options['model'], options['pk'])
+        permext = options['perm']
+        backend = TrustModelBackend()
+
+        try:
+            perm, func = backend._parse_perm(permext, obj.__class__)
+        except (AttributeError, ValueError):
+            raise CommandError('Permission "%s" must be of the form "app_label.action_modelname[:condition]" '
+                'with a condition registered for %s.' % (permext, obj.__class__.__name__))
+
+        with CaptureQueriesContext(connection) as captured:
+            start = time.time()
+            result = user.has_perm(permext, obj)
+            duration = time.time() - start
+        queries = captured.captured_queries
+
+        self.stdout.write('User: %s (pk=%s)%s%s' % (user, user.pk,
+            '' if user.is_active else ', inactive', ', superuser' if user.is_superuser else ''))
+        self.stdout.write('Object: %s (pk=%s)' % (obj, obj.pk))
+
+        trust_ids = sorted(backend._get_trusts(obj))
+        self.stdout.write('Trusts: %s' % (', '.join([str(pk) for pk in trust_ids]) or 'none'))
+
+        branches = get_granting_branches(user, perm, trust_ids)
+        if effective.is_enabled():
+            stored = set(EffectivePermission.objects.filter(entity=user, trust__in=trust_ids,
+                permission__content_type__app_label=perm.split('.', 1)[0],
+                permission__codename=perm.split('.', 1)[1]).values_list('trust', flat=True))
+        for pk in trust_ids:
+            line = '  trust %s: %s' % (pk, ', '.join(branches[pk]) or 'not granted')
+            if effective.is_enabled():
+                line += ' (effective: %s)' % ('granted' if pk in stored else 'not granted')
+            self.stdout.write(line)
+        if grants.is_inherited():
+            self.stdout.write('  grants on ancestors are inherited')
+
+        if func is not None:
+            self.stdout.write('Condition %s: %s' % (permext.split(':', 1)[1],
+                'passed' if func(user, perm, obj) else 'failed'))
+
+        self.stdout.write('Result: %s in %.1fms' % ('granted' if result else 'denied', duration * 1000))
+        self.stdout.write('Queries: %d' % len(queries))
+        for query in queries:
+            self.stdout.write('  [%ss] %s' % (query['time'], query['sql']))
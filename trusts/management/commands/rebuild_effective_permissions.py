@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from trusts import effective
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the EffectivePermission table from all grants.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', action='store', dest='chunk_size', type=int,
+            default=effective.CHUNK_SIZE, help='Number of entities to rebuild per transaction.')
+
+    def handle(self, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+
+        effective.rebuild(chunk_size=options.get('chunk_size', effective.CHUNK_SIZE))
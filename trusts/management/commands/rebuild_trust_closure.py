@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from trusts import closure
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the TrustClosure table from the trust field of all trusts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', action='store', dest='chunk_size', type=int,
+            default=closure.CHUNK_SIZE, help='Number of rows to insert per query.')
+
+    def handle(self, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+
+        closure.rebuild(chunk_size=options.get('chunk_size', closure.CHUNK_SIZE))
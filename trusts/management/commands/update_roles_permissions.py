@@ -3,32 +3,119 @@
 from __future__ import unicode_literals
 
 
-import getpass
-import unicodedata
-
-from django.conf import settings
-from django.core import exceptions
 from django.core.management.base import BaseCommand, CommandError
-from django.db import DEFAULT_DB_ALIAS, router
-from django.db.models import Q
-from django.utils.encoding import DEFAULT_LOCALE_ENCODING
-from django.utils import six
+from django.db import DEFAULT_DB_ALIAS, router, transaction
+
+from trusts.signals import permissions_changed, bulk_change
+
+
+CHUNK_SIZE = 500
 
-def _process_roles(Permission, model_roles, content_klass, roles, using):
-    for rolename, perm_names in roles:
+
+def _get_model_roles(app_config):
+    """
+    Returns a list of ``(rolename, content_klass, perm_names)`` of the roles
+    declared in the models' Meta.
+    """
+
+    model_roles = []
+    for klass in app_config.get_models():
+        if hasattr(klass._meta, 'roles'):
+            model_roles.extend([(rolename, klass, perm_names) for rolename, perm_names in klass._meta.roles])
+        elif hasattr(klass._meta, 'content_roles'):
+            if hasattr(klass, 'get_content_model'):
+                content_klass = klass.get_content_model()
+                model_roles.extend([(rolename, content_klass, perm_names)
+                    for rolename, perm_names in klass._meta.content_roles])
+    return model_roles
+
+
+def _resolve_model_roles(Permission, model_roles, using):
+    """
+    Returns a dict of role name to the set of pks of its permissions, looked
+    up with a single query.
+    """
+
+    # Force looking up the content types in the current database
+    # before creating foreign keys to them.
+    from django.contrib.contenttypes.models import ContentType
+    ctypes = ContentType.objects.db_manager(using).get_for_models(
+        *set([content_klass for rolename, content_klass, perm_names in model_roles]))
+
+    perm_ids = {}
+    for pk, ctype_id, codename in Permission.objects.using(using).filter(content_type__in=ctypes.values()) \
+            .values_list('pk', 'content_type_id', 'codename'):
+        perm_ids[(ctype_id, codename)] = pk
+
+    roles = {}
+    for rolename, content_klass, perm_names in model_roles:
+        ctype = ctypes[content_klass]
+        role_perm_ids = roles.setdefault(rolename, set())
+        for perm_name in perm_names:
+            if (ctype.pk, perm_name) not in perm_ids:
+                raise CommandError('Permission "%s.%s" of role "%s" does not exist.' % (
+                    ctype.app_label, perm_name, rolename))
+            role_perm_ids.add(perm_ids[(ctype.pk, perm_name)])
+    return roles
+
+
+def get_plan(Role, Permission, RolePermission, app_config, using=DEFAULT_DB_ALIAS):
+    """
+    Returns the changes bringing the roles in the database up to date with
+    the roles of the models, as a dict of:
+
+    ``added_roles``: names of the roles to create,
+    ``added``: ``(rolename, permission_id)`` of the role permissions to create,
+    ``deleted``: ``(rolename, role_id, rolepermission_id, permission_id)`` of
+    the managed role permissions to delete,
+    ``deleted_roles``: ``(rolename, role_id)`` of the roles to delete if they
+    have no permission left.
+    """
+
+    model_roles = _resolve_model_roles(Permission, _get_model_roles(app_config), using)
+
+    db_roles = dict(Role.objects.using(using).values_list('name', 'pk'))
+    db_rolenames = dict([(pk, name) for name, pk in db_roles.items()])
+    db_rolepermissions = {}
+    for pk, role_id, permission_id, managed in RolePermission.objects.using(using) \
+            .values_list('pk', 'role_id', 'permission_id', 'managed'):
+        db_rolepermissions.setdefault(db_rolenames[role_id], {})[permission_id] = (pk, managed)
+
+    plan = {'added_roles': [], 'added': [], 'deleted': [], 'deleted_roles': []}
+    for rolename in sorted(model_roles):
+        if rolename not in db_roles:
+            plan['added_roles'].append(rolename)
+        db_permissions = db_rolepermissions.get(rolename, {})
+        plan['added'].extend([(rolename, permission_id)
+            for permission_id in sorted(model_roles[rolename]) if permission_id not in db_permissions])
+
+    for rolename in sorted(db_roles):
+        model_permissions = model_roles.get(rolename, set())
+        plan['deleted'].extend([(rolename, db_roles[rolename], pk, permission_id)
+            for permission_id, (pk, managed) in sorted(db_rolepermissions.get(rolename, {}).items())
+            if managed and permission_id not in model_permissions])
         if rolename not in model_roles:
-            model_roles[rolename] = set()
+            plan['deleted_roles'].append((rolename, db_roles[rolename]))
+
+    return plan
+
 
-        # Force looking up the content types in the current database
-        # before creating foreign keys to them.
-        from django.contrib.contenttypes.models import ContentType
-        ctype = ContentType.objects.db_manager(using).get_for_model(content_klass)
+def print_plan(Permission, plan, using=DEFAULT_DB_ALIAS):
+    perm_ids = set([permission_id for rolename, permission_id in plan['added']] +
+        [permission_id for rolename, role_id, pk, permission_id in plan['deleted']])
+    perms = dict([(perm.pk, perm) for perm in Permission.objects.using(using).filter(pk__in=perm_ids)])
 
-        model_roles[rolename].update([Permission.objects.get(content_type=ctype, codename=perm_name)
-                for perm_name in perm_names
-        ])
+    for rolename in plan['added_roles']:
+        print('Adding role "%s"' % rolename)
+    for rolename, permission_id in plan['added']:
+        print('Adding role(%s).rolepermission "%s"' % (rolename, perms[permission_id]))
+    for rolename, role_id, pk, permission_id in plan['deleted']:
+        print('Removing role(%s).rolepermission "%s"' % (rolename, perms[permission_id]))
+    for rolename, role_id in plan['deleted_roles']:
+        print('Removing role "%s"' % rolename)
 
-def update_roles_permissions(Role, Permission, RolePermission, app_config, verbosity=2, interactive=True, using=DEFAULT_DB_ALIAS, **kwargs):
+
+def update_roles_permissions(Role, Permission, RolePermission, app_config, verbosity=2, interactive=True, using=DEFAULT_DB_ALIAS, dry_run=False, **kwargs):
     if not router.allow_migrate_model(using, Role):
         return
 
@@ -37,87 +124,47 @@ def update_roles_permissions(Role, Permission, RolePermission, app_config, verbo
     except LookupError:
         return
 
-    # This will hold the roles we're looking for as
-    # (rolename (permissions))
-    model_roles = {}
-    for klass in app_config.get_models():
-        if hasattr(klass._meta, 'roles'):
-            _process_roles(Permission, model_roles, klass, klass._meta.roles, using)
-        elif hasattr(klass._meta, 'content_roles'):
-            if hasattr(klass, 'get_content_model'):
-                content_klass = klass.get_content_model()
-                _process_roles(Permission, model_roles, content_klass, klass._meta.content_roles, using)
-
-    # Find all the Roles and its Permission
-    db_roles = {}
-    for r in Role.objects.using(using).all():
-        db_roles[r.name] = set(r.permissions.all())
-
-    # Get all the diff between sets
-    model_rolenames = set(model_roles.keys())
-    db_rolenames = set(db_roles.keys())
-    added_rolenames = model_rolenames - db_rolenames
-    deleted_rolenames = db_rolenames - model_rolenames
-    existing_rolenames = model_rolenames.intersection(db_rolenames)
-
-    # Prepare rolepermissions for bulk op at the end
-    bulk_add_rolepermissions = []
-    q_del_rolepermissions = []
-    deleted_role_ids = []
-    # Process added roles
-    for rolename in added_rolenames:
-        r = Role(name=rolename)
-        r.save()
-        for p in model_roles[rolename]:
-            bulk_add_rolepermissions.append(RolePermission(managed=True, permission=p, role=r))
-
-    # Process existing roles
-    for rolename in existing_rolenames:
-        r = Role.objects.get(name=rolename)
-        db_permissions = db_roles[rolename]
-        model_permissions = model_roles[rolename]
-
-        added_permissions = set(model_permissions) - set(db_permissions)
-        for p in added_permissions:
-            bulk_add_rolepermissions.append(RolePermission(managed=True, permission=p, role=r))
-
-        deleted_permissions = set(db_permissions) - set(model_permissions)
-        if len(deleted_permissions):
-            q_del_rolepermissions.append((r, Q(managed=True, role=r, permission__in=deleted_permissions)))
-
-    # Process deleted roles
-    for rolename in deleted_rolenames:
-        r = Role.objects.get(name=rolename)
-        q_del_rolepermissions.append((r, Q(managed=True, role=r)))
-        deleted_role_ids.append(r.pk)
-
-    # Create the added role permissions
-    RolePermission.objects.using(using).bulk_create(bulk_add_rolepermissions)
-    if verbosity >= 2:
-        for rolepermission in bulk_add_rolepermissions:
-            print('Adding role(%s).rolepermission "%s"' % (rolepermission.role.name, rolepermission))
-
-    # Remove the deleted role permissions
-    for r, q in q_del_rolepermissions:
-        qs = RolePermission.objects.filter(q)
-        if verbosity >= 2:
-            if qs.count() > 0:
-                for rolepermission in qs.all():
-                    print('Removing role(%s).rolepermission "%s"' % (rolepermission.role.name, rolepermission))
-        qs.delete()
-
-    # Remove the deleted role
-    qs = Role.objects.filter(pk__in=deleted_role_ids, permissions__isnull=True)
-    if verbosity >= 2:
-        if qs.count() > 0:
-            for role in qs.all():
-                print('Removing role "%s"' % (role.name))
-    qs.delete()
+    with transaction.atomic(using=using):
+        plan = get_plan(Role, Permission, RolePermission, app_config, using)
+        if verbosity >= 2 or dry_run:
+            print_plan(Permission, plan, using)
+        if dry_run:
+            return plan
+
+        # bulk_create() does not set the pks of the created roles
+        Role.objects.using(using).bulk_create([Role(name=rolename) for rolename in plan['added_roles']])
+        role_ids = dict(Role.objects.using(using).filter(name__in=set([rolename for rolename, permission_id in plan['added']]))
+            .values_list('name', 'pk'))
+        RolePermission.objects.using(using).bulk_create([
+            RolePermission(managed=True, permission_id=permission_id, role_id=role_ids[rolename])
+            for rolename, permission_id in plan['added']
+        ], batch_size=CHUNK_SIZE)
+
+        # The deleted rows are announced below with the created ones
+        deleted_ids = [pk for rolename, role_id, pk, permission_id in plan['deleted']]
+        with bulk_change():
+            for i in range(0, len(deleted_ids), CHUNK_SIZE):
+                RolePermission.objects.using(using).filter(pk__in=deleted_ids[i:i + CHUNK_SIZE]).delete()
+
+        changed_role_ids = set(role_ids.values())
+        changed_role_ids.update([role_id for rolename, role_id, pk, permission_id in plan['deleted']])
+        if len(changed_role_ids):
+            permissions_changed.send(sender=RolePermission, role_ids=changed_role_ids)
+
+        # Roles still holding unmanaged permissions are kept
+        Role.objects.using(using).filter(pk__in=[role_id for rolename, role_id in plan['deleted_roles']],
+            permissions__isnull=True).delete()
+
+    return plan
 
 
 class Command(BaseCommand):
     help = 'Create Role objects linking to permission defined in models\'s meta class.'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Print the changes without applying them.')
+
     def handle(self, **options):
         self.verbosity = int(options.get('verbosity', 1))
 
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+
+from django.core.exceptions import FieldDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from trusts import get_entity_model, cache
+
+
+CHUNK_SIZE = 500
+
+
+def warm_chunk(user_ids):
+    try:
+        return cache.warm(list(get_entity_model()._default_manager.filter(pk__in=user_ids)))
+    finally:
+        # Each worker thread has its own connection
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = 'Store the per-trust permissions of recently active users in the shared permission cache.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', action='store', dest='days', type=int, default=7,
+            help='Warm the users who logged in within this number of days.')
+        parser.add_argument('--chunk-size', action='store', dest='chunk_size', type=int,
+            default=CHUNK_SIZE, help='Number of users to load the permissions of per query.')
+        parser.add_argument('--workers', action='store', dest='workers', type=int, default=1,
+            help='Number of threads loading chunks concurrently.')
+
+    def handle(self, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+
+        if cache.get_cache() is None:
+            raise CommandError('TRUSTS_PERMISSION_CACHE does not name a cache.')
+
+        User = get_entity_model()
+        try:
+            User._meta.get_field('last_login')
+        except FieldDoesNotExist:
+            raise CommandError('"%s" has no last_login field.' % User.__name__)
+
+        since = timezone.now() - timedelta(days=options.get('days', 7))
+        user_ids = list(User._default_manager.filter(is_active=True, last_login__gte=since)
+            .order_by('pk').values_list('pk', flat=True))
+
+        chunk_size = options.get('chunk_size', CHUNK_SIZE)
+        chunks = [user_ids[i:i + chunk_size] for i in range(0, len(user_ids), chunk_size)]
+        workers = options.get('workers', 1)
+        if workers > 1:
+            pool = ThreadPool(workers)
+            try:
+                counts = pool.map(warm_chunk, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            counts = [cache.warm(list(User._default_manager.filter(pk__in=chunk))) for chunk in chunks]
+
+        if self.verbosity >= 1:
+            self.stdout.write('Stored %d entries for %d users.' % (sum(counts), len(user_ids)))
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import threading
+
+from django.conf import settings
+
+from trusts.signals import permission_checked
+
+
+logger = logging.getLogger('trusts')
+
+HEADER = 'X-Trusts-Permission-Checks'
+
+_local = threading.local()
+
+
+class RequestStats(object):
+    """
+    Totals of the permission checks of a request.
+    """
+
+    def __init__(self):
+        self.checks = 0
+        self.hits = 0
+        self.misses = 0
+        self.queries = 0
+        self.duration = 0.0
+        self.trusts = {}
+
+    def add(self, hits, misses, queries, duration, **kwargs):
+        self.checks += 1
+        self.hits += len(hits)
+        self.misses += len(misses)
+        self.queries += queries or 0
+        self.duration += duration
+
+        for pk in hits:
+            self.trusts.setdefault(pk, [0, 0])[0] += 1
+        for pk in misses:
+            self.trusts.setdefault(pk, [0, 0])[1] += 1
+
+    def __str__(self):
+        return 'checks=%d; hits=%d; misses=%d; queries=%d; time=%.1fms' % (
+            self.checks, self.hits, self.misses, self.queries, self.duration * 1000)
+
+
+def record_permission_checked(sender, **kwargs):
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.add(**kwargs)
+
+
+class PermissionStatsMiddleware(object):
+    """
+    Totals the object permission checks of each request, and logs them to the
+    ``trusts`` logger. With ``DEBUG``, the totals are also sent in the
+    ``X-Trusts-Permission-Checks`` response header. Queries are only counted
+    while they are logged, ie, with ``DEBUG``.
+    """
+
+    def __init__(self):
+        permission_checked.connect(record_permission_checked, dispatch_uid='trusts_permission_stats')
+
+    def process_request(self, request):
+        _local.stats = RequestStats()
+
+    def process_response(self, request, response):
+        stats = getattr(_local, 'stats', None)
+        _local.stats = None
+        if stats is None or not stats.checks:
+            return response
+
+        logger.info('%s %s: %s', request.method, request.path, stats,
+            extra={'trusts': {pk: {'hits': hits, 'misses': misses} for pk, (hits, misses) in stats.trusts.items()}})
+        if settings.DEBUG:
+            response[HEADER] = str(stats)
+        return response
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+
+from trusts import ENTITY_MODEL_NAME, PERMISSION_MODEL_NAME
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('auth', '0006_require_contenttypes_0002'),
+        ('trusts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EffectivePermission',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('entity', models.ForeignKey(to=ENTITY_MODEL_NAME, related_name='effectivepermissions')),
+                ('permission', models.ForeignKey(to=PERMISSION_MODEL_NAME, related_name='effectivepermissions')),
+                ('trust', models.ForeignKey(to='trusts.Trust', related_name='effectivepermissions')),
+            ],
+            options={
+                'default_permissions': (),
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='effectivepermission',
+            unique_together=set([('entity', 'trust', 'permission')]),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trusts', '0002_effectivepermission'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrustClosure',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(to='trusts.Trust', related_name='closure_descendants')),
+                ('descendant', models.ForeignKey(to='trusts.Trust', related_name='closure_ancestors')),
+            ],
+            options={
+                'default_permissions': (),
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='trustclosure',
+            unique_together=set([('ancestor', 'descendant')]),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def get_indexes(apps):
+    """
+    Returns ``(model, columns, name)`` of the indexes of the many-to-many
+    tables joined from a group to its trusts and roles. Their unique
+    constraints only lead with the trust and the role.
+    """
+
+    indexes = []
+    for model_name, name in (('Trust', 'trust'), ('Role', 'role')):
+        through = apps.get_model('trusts', model_name)._meta.get_field('groups').rel.through
+        columns = [through._meta.get_field('group').column, through._meta.get_field(name).column]
+        indexes.append((through, columns, '%s_group_%s' % (through._meta.db_table, name)))
+    return indexes
+
+
+def create_indexes(apps, schema_editor):
+    for model, columns, name in get_indexes(apps):
+        schema_editor.execute(schema_editor.sql_create_index % {
+            'table': schema_editor.quote_name(model._meta.db_table),
+            'name': schema_editor.quote_name(name),
+            'columns': ', '.join([schema_editor.quote_name(column) for column in columns]),
+            'extra': '',
+        })
+
+
+def drop_indexes(apps, schema_editor):
+    for model, columns, name in get_indexes(apps):
+        schema_editor.execute(schema_editor.sql_delete_index % {
+            'table': schema_editor.quote_name(model._meta.db_table),
+            'name': schema_editor.quote_name(name),
+        })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trusts', '0003_trustclosure'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='trustuserpermission',
+            index_together=set([('entity', 'trust', 'permission')]),
+        ),
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -3,22 +3,98 @@ from __future__ import unicode_literals
 
 from datetime import datetime
 
+import six
+
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
 from django.db.models import signals, Q, options
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext_lazy as _
 
 from trusts import ENTITY_MODEL_NAME, PERMISSION_MODEL_NAME, GROUP_MODEL_NAME, \
-                    DEFAULT_SETTLOR, ALLOW_NULL_SETTLOR, ROOT_PK, utils
+                    DEFAULT_SETTLOR, ALLOW_NULL_SETTLOR, ROOT_PK, get_permission_model, utils
 
 
 options.DEFAULT_NAMES += ('roles', 'permission_conditions',
                           'content_roles', 'content_permission_conditions'
     )
 
-class TrustManager(models.Manager):
+# Keeps the lookups of a chunk of triples under SQLite's 999 parameters
+CHUNK_SIZE = 300
+
+
+def _get_pk(obj):
+    return getattr(obj, 'pk', obj)
+
+
+def _chunks(rows, chunk_size):
+    for i in range(0, len(rows), chunk_size):
+        yield rows[i:i + chunk_size]
+
+
+def _filter_rows(model, fields, rows):
+    """
+    Returns a dict of the values of ``fields`` to the pk of the rows of
+    ``model`` among ``rows``, looked up with a query on the ``__in`` of
+    each field.
+    """
+
+    filters = {'%s__in' % field: set([row[i] for row in rows]) for i, field in enumerate(fields)}
+    existing = {}
+    for values in model._default_manager.filter(**filters).values_list('pk', *fields):
+        existing[tuple(values[1:])] = values[0]
+    return {row: existing[row] for row in rows if row in existing}
+
+
+def _create_many(model, fields, rows, chunk_size=CHUNK_SIZE):
+    """
+    Creates the rows of ``model``, given as tuples of the pks of its
+    ``fields``, which do not exist yet. Returns the rows created.
+    """
+
+    created = []
+    with transaction.atomic():
+        for chunk in _chunks(sorted(set(rows)), chunk_size):
+            existing = _filter_rows(model, fields, chunk)
+            chunk = [row for row in chunk if row not in existing]
+            model._default_manager.bulk_create([model(**dict(zip(fields, row))) for row in chunk])
+            created.extend(chunk)
+    return created
+
+
+def _delete_many(model, fields, rows, chunk_size=CHUNK_SIZE):
+    """
+    Deletes the rows of ``model``, given as tuples of the pks of its
+    ``fields``. Returns the rows deleted.
+    """
+
+    deleted = []
+    with transaction.atomic():
+        for chunk in _chunks(sorted(set(rows)), chunk_size):
+            existing = _filter_rows(model, fields, chunk)
+            # The per-row post_delete of TrustUserPermission is silenced by
+            # bulk_change(); the many-to-many tables are deleted directly
+            model._default_manager.filter(pk__in=existing.values()).delete()
+            deleted.extend(existing.keys())
+    return deleted
+
+class ContentQuerySet(models.QuerySet):
+    def permitted(self, user, action):
+        """
+        Returns the objects whose trust grants the ``action`` permission of
+        the model, ie, ``'read'``, to the user.
+        """
+
+        return Trust.objects.filter_content_by_user_permission(self, user,
+                '%s.%s_%s' % (self.model._meta.app_label, action, self.model._meta.model_name))
+
+
+class ContentManager(models.Manager.from_queryset(ContentQuerySet)):
+    pass
+
+
+class TrustManager(ContentManager):
     def get_or_create_settlor_default(self, settlor, defaults={}, **kwargs):
         if 'trust' in kwargs:
             raise TypeError('"%s" are invalid keyword arguments' % 'trust')
@@ -41,6 +117,100 @@ class TrustManager(models.Manager):
     def get_root(self):
         return self.get(pk=ROOT_PK)
 
+    def grant_many(self, trust_groups, chunk_size=CHUNK_SIZE):
+        """
+        Links the trusts to the groups of the ``(trust, group)`` pairs, given
+        as objects or pks, skipping existing links. Sends a single
+        ``permissions_changed``. Returns the number of links created.
+        """
+
+        rows = [(_get_pk(trust), _get_pk(group)) for trust, group in trust_groups]
+        return self._change_groups(_create_many, rows, chunk_size)
+
+    def revoke_many(self, trust_groups, chunk_size=CHUNK_SIZE):
+        """
+        Unlinks the trusts from the groups of the ``(trust, group)`` pairs.
+        Sends a single ``permissions_changed``. Returns the number of links
+        deleted.
+        """
+
+        rows = [(_get_pk(trust), _get_pk(group)) for trust, group in trust_groups]
+        return self._change_groups(_delete_many, rows, chunk_size)
+
+    def transfer_contents(self, model_or_qs, from_trust, to_trust, chunk_size=CHUNK_SIZE):
+        """
+        Moves the objects of a ``Content`` or ``Junction`` model, or of a
+        QuerySet of one, from a trust to another with chunked updates in a
+        transaction, bypassing the readonly ``trust`` field. Trusts moved
+        this way take their descendants along. Sends a single
+        ``permissions_changed``. Returns the number of objects moved.
+        """
+
+        from trusts import grants
+        from trusts.signals import permissions_changed
+
+        if isinstance(model_or_qs, models.QuerySet):
+            qs = model_or_qs
+        else:
+            qs = model_or_qs._default_manager.all()
+        if not issubclass(qs.model, (Content, Junction)):
+            raise TypeError('"%s" is not a content or junction model.' % utils.get_short_model_name(qs.model))
+
+        from_pk, to_pk = _get_pk(from_trust), _get_pk(to_trust)
+        qs = qs.filter(trust=from_pk)
+        if issubclass(qs.model, Trust):
+            # The root trust is its own parent
+            qs = qs.exclude(pk=from_pk)
+
+        trust_ids = set([from_pk, to_pk])
+        with transaction.atomic():
+            pks = list(qs.order_by().values_list('pk', flat=True))
+            if issubclass(qs.model, Trust) and set(pks) & self._get_ancestor_ids(to_pk):
+                raise ValueError('Trusts cannot be moved under their own descendant %s.' % to_pk)
+
+            for chunk in _chunks(pks, chunk_size):
+                qs.model._default_manager.filter(pk__in=chunk).update(trust=to_pk)
+
+            if issubclass(qs.model, Trust) and grants.is_inherited():
+                from trusts import closure
+                for pk in pks:
+                    trust_ids.update(closure.move(Trust(pk=pk, trust_id=to_pk)))
+
+        if len(pks):
+            permissions_changed.send(sender=qs.model, trust_ids=trust_ids)
+        return len(pks)
+
+    def _get_ancestor_ids(self, pk):
+        """
+        Returns the pks of a trust and of all its ancestors, read from
+        ``TrustClosure`` when it is kept up to date, or else by walking up the
+        parents.
+        """
+
+        from trusts import grants
+
+        if grants.is_inherited():
+            return set(TrustClosure.objects.filter(descendant=pk).values_list('ancestor', flat=True)) | set([pk])
+
+        ancestor_ids = set([pk])
+        while True:
+            parent_id = self.filter(pk=pk).values_list('trust_id', flat=True).first()
+            if parent_id is None or parent_id in ancestor_ids:
+                return ancestor_ids
+            ancestor_ids.add(parent_id)
+            pk = parent_id
+
+    def _change_groups(self, func, rows, chunk_size):
+        from trusts.signals import permissions_changed, bulk_change
+
+        through = self.model.groups.through
+        with bulk_change():
+            changed = func(through, ('trust_id', 'group_id'), rows, chunk_size)
+        if len(changed):
+            permissions_changed.send(sender=through, trust_ids=set([row[0] for row in changed]),
+                group_ids=set([row[1] for row in changed]))
+        return len(changed)
+
     def filter_by_content(self, obj):
         if isinstance(obj, models.QuerySet):
             klass = obj.model
@@ -69,26 +239,92 @@ class TrustManager(models.Manager):
 
         return self.filter(Q(groups__user=user) | Q(trustees__entity=user), **kwargs)
 
+    def filter_by_user_permission(self, user, perm):
+        """
+        Returns the trusts granting ``perm`` to the user directly, through
+        one of the user's groups or through a role of those groups, or
+        inheriting it from an ancestor with ``TRUSTS_INHERIT_PERMISSIONS``.
+        """
+
+        from trusts import effective, grants
+
+        applabel, codename = perm.split('.', 1)
+        if ':' in codename:
+            raise ValueError('Permission condition is not supported. Actual: %s' % perm)
+
+        perms = get_permission_model().objects.filter(content_type__app_label=applabel, codename=codename)
+        if effective.is_enabled():
+            return self.filter(pk__in=EffectivePermission.objects.filter(permission__in=perms, entity=user).values('trust'))
+
+        trusts = self.filter(
+            Q(pk__in=self.filter(groups__permissions__in=perms, groups__user=user).values('pk')) |
+            Q(pk__in=self.filter(groups__roles__permissions__in=perms, groups__user=user).values('pk')) |
+            Q(pk__in=TrustUserPermission.objects.filter(permission__in=perms, entity=user).values('trust'))
+        )
+        if grants.is_inherited():
+            return self.filter(pk__in=TrustClosure.objects.filter(ancestor__in=trusts).values('descendant'))
+        return trusts
+
+    def filter_content_by_user_permission(self, obj, user, perm):
+        """
+        Filters the content QuerySet ``obj`` down to the objects whose trust
+        grants ``perm`` to the user, with a single query.
+        """
+
+        if not Content.is_content_model(obj.model):
+            raise TypeError('"%s" is not a content model.' % utils.get_short_model_name(obj.model))
+
+        if user.is_anonymous() or not user.is_active:
+            return obj.none()
+        if user.is_superuser:
+            return obj
+
+        return obj.filter(self.get_content_permission_q(obj.model, user, perm))
+
+    def get_content_permission_q(self, model, user, perm):
+        """
+        Returns a ``Q`` matching the objects of the content ``model`` whose
+        trust grants ``perm`` to the user.
+        """
+
+        trusts = self.filter_by_user_permission(user, perm)
+        fieldlookup = Content.get_content_fieldlookup(model)
+        if fieldlookup is None:
+            return Q(trust__in=trusts)
+        return Q(pk__in=trusts.values(fieldlookup))
+
 
 class ReadonlyFieldsMixin(object):
+    """
+    Forbids changing the ``_readonly_fields`` of a saved object in
+    ``clean()``. Their raw values, ie, ``trust_id``, are snapshotted without
+    fetching related objects, and deferred fields are not snapshotted.
+    """
+
     def __init__(self, *args, **kwargs):
         super(ReadonlyFieldsMixin, self).__init__(*args, **kwargs)
 
         if hasattr(self, '_readonly_fields'):
             self._state.init_fields = {
-                field: getattr(self, field) for field in self._readonly_fields
-                        if hasattr(self, field)
+                attname: self.__dict__[attname] for attname in self._get_readonly_attnames()
+                        if attname in self.__dict__
             }
 
+    @classmethod
+    def _get_readonly_attnames(cls):
+        if '_readonly_attnames' not in cls.__dict__:
+            cls._readonly_attnames = tuple([cls._meta.get_field(field).attname for field in cls._readonly_fields])
+        return cls._readonly_attnames
+
     def clean(self):
         super(ReadonlyFieldsMixin, self).clean()
 
         if hasattr(self, '_readonly_fields') and hasattr(self._state, 'init_fields'):
-            for field in self._readonly_fields:
-                if field in self._state.init_fields:
-                    saved_value = self._state.init_fields[field]
-                    if saved_value != getattr(self, field):
-                        raise ValidationError('Field "%s" is readonly.' % 'trust')
+            for field, attname in zip(self._readonly_fields, self._get_readonly_attnames()):
+                if attname in self._state.init_fields:
+                    saved_value = self._state.init_fields[attname]
+                    if saved_value != getattr(self, attname):
+                        raise ValidationError('Field "%s" is readonly.' % field)
 
 
 class Content(ReadonlyFieldsMixin, models.Model):
@@ -96,6 +332,9 @@ class Content(ReadonlyFieldsMixin, models.Model):
                 default=ROOT_PK, null=False, blank=False)
     _contents = {}
     _conditions = {}
+    _resolved = {}
+
+    objects = ContentManager()
 
     class Meta:
         abstract = True
@@ -108,51 +347,74 @@ class Content(ReadonlyFieldsMixin, models.Model):
         if short_name not in Content._conditions:
             Content._conditions[short_name] = {}
         Content._conditions[short_name][cond_code] = func
+        Content.clear_cache()
 
     @staticmethod
     def register_content(klass, fieldlookup=None):
+        short_name = utils.get_short_model_name(klass)
         if fieldlookup is None:
             content_model_fields = [f for f in klass._meta.fields if f.rel is not None and f.name == 'trust']
             if len(content_model_fields) != 1:
                 raise AttributeError('Expect "trust" field in model %s.' % short_name)
-        short_name = utils.get_short_model_name(klass)
         Content._contents[short_name] = fieldlookup
+        Content.clear_cache()
 
         if hasattr(klass._meta, 'permission_conditions'):
             for permcond, func in klass._meta.permission_conditions:
                 Content.register_permission_condition(klass, permcond, func)
 
+    @staticmethod
+    def clear_cache():
+        """
+        Clears the registrations resolved by class. Registering clears it.
+        """
+
+        Content._resolved.clear()
+
+    @staticmethod
+    def _resolve(klass):
+        """
+        Returns ``(is_content, fieldlookup, conditions)`` of a model class, or
+        of a model name, as registered for the class or else for its closest
+        registered base class. Results are memoized by class.
+        """
+
+        try:
+            return Content._resolved[klass]
+        except KeyError:
+            pass
+
+        if isinstance(klass, six.string_types):
+            short_names = [klass]
+        else:
+            short_names = [utils.get_short_model_name(base) for base in klass.__mro__ if hasattr(base, '_meta')]
+
+        registered = [short_name for short_name in short_names if short_name in Content._contents]
+        conditions = {}
+        for short_name in reversed(short_names):
+            conditions.update(Content._conditions.get(short_name, {}))
+
+        resolved = (len(registered) > 0, Content._contents[registered[0]] if registered else None, conditions)
+        Content._resolved[klass] = resolved
+        return resolved
+
     @staticmethod
     def is_content_model(klass):
-        short_name = utils.get_short_model_name(klass)
-        if short_name in Content._contents.keys():
-            return True
-        return False
+        return Content._resolve(klass)[0]
 
     @staticmethod
     def get_content_fieldlookup(klass):
-        short_name = utils.get_short_model_name(klass)
-        if short_name in Content._contents.keys():
-            return Content._contents[short_name]
-        return None
+        return Content._resolve(klass)[1]
 
     @staticmethod
     def is_content(obj):
         if isinstance(obj, models.QuerySet):
-            klass = obj.model
-            is_qs = True
-        else:
-            klass = obj.__class__
-            is_qs = False
-        return Content.is_content_model(klass)
+            return Content.is_content_model(obj.model)
+        return Content.is_content_model(obj.__class__)
 
     @staticmethod
     def get_permission_condition_func(klass, cond_code):
-        short_name = utils.get_short_model_name(klass)
-        if short_name in Content._conditions:
-            if cond_code in Content._conditions[short_name]:
-                return Content._conditions[short_name][cond_code]
-        return None
+        return Content._resolve(klass)[2].get(cond_code)
 
 
 class Trust(Content):
@@ -202,13 +464,79 @@ class RolePermission(models.Model):
         unique_together = ('role', 'permission')
 
 
+class TrustUserPermissionManager(models.Manager):
+    def grant_many(self, grants, chunk_size=CHUNK_SIZE):
+        """
+        Grants the permissions of the ``(trust, entity, permission)`` triples,
+        given as objects or pks, skipping existing grants. Sends a single
+        ``permissions_changed``. Returns the number of grants created.
+        """
+
+        rows = [(_get_pk(trust), _get_pk(entity), _get_pk(permission)) for trust, entity, permission in grants]
+        return self._change(_create_many, rows, chunk_size)
+
+    def revoke_many(self, grants, chunk_size=CHUNK_SIZE):
+        """
+        Revokes the permissions of the ``(trust, entity, permission)``
+        triples. Sends a single ``permissions_changed``. Returns the number of
+        grants deleted.
+        """
+
+        rows = [(_get_pk(trust), _get_pk(entity), _get_pk(permission)) for trust, entity, permission in grants]
+        return self._change(_delete_many, rows, chunk_size)
+
+    def _change(self, func, rows, chunk_size):
+        from trusts.signals import permissions_changed, bulk_change
+
+        with bulk_change():
+            changed = func(self.model, ('trust_id', 'entity_id', 'permission_id'), rows, chunk_size)
+        if len(changed):
+            permissions_changed.send(sender=self.model, trust_ids=set([row[0] for row in changed]),
+                entity_ids=set([row[1] for row in changed]))
+        return len(changed)
+
+
 class TrustUserPermission(models.Model):
     trust = models.ForeignKey('trusts.Trust', related_name='trustees', null=False, blank=False)
     entity = models.ForeignKey(ENTITY_MODEL_NAME, related_name='trustpermissions', null=False, blank=False)
     permission = models.ForeignKey(PERMISSION_MODEL_NAME, related_name='trustentities', null=False, blank=False)
 
+    objects = TrustUserPermissionManager()
+
     class Meta:
         unique_together = ('trust', 'entity', 'permission')
+        # Covers the lookup of the permissions of entities on trusts
+        index_together = (('entity', 'trust', 'permission'), )
+
+
+class EffectivePermission(models.Model):
+    """
+    Denormalized permissions of an entity on a trust, maintained from all
+    grants when ``TRUSTS_EFFECTIVE_PERMISSIONS`` is set.
+    """
+
+    trust = models.ForeignKey('trusts.Trust', related_name='effectivepermissions', null=False, blank=False)
+    entity = models.ForeignKey(ENTITY_MODEL_NAME, related_name='effectivepermissions', null=False, blank=False)
+    permission = models.ForeignKey(PERMISSION_MODEL_NAME, related_name='effectivepermissions', null=False, blank=False)
+
+    class Meta:
+        unique_together = ('entity', 'trust', 'permission')
+        default_permissions = ()
+
+
+class TrustClosure(models.Model):
+    """
+    Every ancestor of every trust, itself included at depth 0, maintained
+    when ``TRUSTS_INHERIT_PERMISSIONS`` is set.
+    """
+
+    ancestor = models.ForeignKey('trusts.Trust', related_name='closure_descendants', null=False, blank=False)
+    descendant = models.ForeignKey('trusts.Trust', related_name='closure_ancestors', null=False, blank=False)
+    depth = models.PositiveIntegerField(null=False, blank=False)
+
+    class Meta:
+        unique_together = ('ancestor', 'descendant')
+        default_permissions = ()
 
 
 class Junction(ReadonlyFieldsMixin, models.Model):
@@ -241,6 +569,19 @@ class Junction(ReadonlyFieldsMixin, models.Model):
     def get_fieldlookup(cls):
         return '%s__content' % utils.get_short_model_name_lower(cls).replace('.', '_')
 
+    @classmethod
+    def permitted(cls, user, action, queryset=None):
+        """
+        Returns the content objects whose junction's trust grants the
+        ``action`` permission of the content model to the user.
+        """
+
+        content_model = cls.get_content_model()
+        if queryset is None:
+            queryset = content_model._default_manager.all()
+        return Trust.objects.filter_content_by_user_permission(queryset, user,
+                '%s.%s_%s' % (content_model._meta.app_label, action, content_model._meta.model_name))
+
 
 def register_content_junction(sender, **kwargs):
     if issubclass(sender, Junction):
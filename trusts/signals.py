@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+from contextlib import contextmanager
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import signals
+from django.dispatch import Signal
+
+from trusts import get_entity_model, get_group_model, grants
+from trusts.models import Trust, TrustClosure, Role, RolePermission, TrustUserPermission
+
+
+# Sent whenever a grant changes. Each argument is an iterable of pks, or
+# ``None`` when it is not known: ``trust_ids`` and ``entity_ids`` name the
+# trusts and entities directly affected, while ``group_ids`` and ``role_ids``
+# stand in for the trusts and entities reachable through them.
+permissions_changed = Signal(providing_args=['trust_ids', 'entity_ids', 'group_ids', 'role_ids'])
+
+# Sent after each object permission check of ``TrustModelBackend`` while it
+# has receivers. ``hits`` and ``misses`` are the pks of the trusts whose
+# permissions were found in a cache or loaded from the database, ``queries``
+# is the number of queries issued or ``None`` if queries are not logged, and
+# ``duration`` is in seconds.
+permission_checked = Signal(providing_args=['user', 'perm', 'obj', 'result', 'hits', 'misses', 'queries', 'duration'])
+
+
+_local = threading.local()
+
+
+def get_deleted_trust_ids():
+    """
+    Returns the pks of the trusts being deleted in this thread, whose grants
+    go away with them.
+    """
+
+    return getattr(_local, 'deleted_trust_ids', set())
+
+
+@contextmanager
+def bulk_change():
+    """
+    Silences the per-row ``permissions_changed`` of grants saved or deleted
+    in this thread, for bulk operations sending a single aggregated one.
+    """
+
+    depth = getattr(_local, 'bulk_depth', 0)
+    _local.bulk_depth = depth + 1
+    try:
+        yield
+    finally:
+        _local.bulk_depth = depth
+
+
+def resolve_affected(trust_ids=None, entity_ids=None, group_ids=None, role_ids=None, **kwargs):
+    """
+    Returns the ``(entity_ids, trust_ids)`` sets whose permissions may be
+    affected by a ``permissions_changed`` event.
+    """
+
+    group_ids = set(group_ids or [])
+    if role_ids:
+        group_ids.update(get_group_model().objects.filter(roles__in=role_ids).values_list('pk', flat=True))
+
+    if trust_ids is None:
+        trust_ids = []
+        if len(group_ids):
+            trust_ids = Trust.objects.filter(groups__in=group_ids).values_list('pk', flat=True)
+
+    if entity_ids is None:
+        entity_ids = []
+        if len(group_ids):
+            entity_ids = get_entity_model().objects.filter(groups__in=group_ids).values_list('pk', flat=True)
+        elif len(trust_ids) and grants.is_inherited():
+            # Trusts moved in the hierarchy affect everyone granted on their ancestors
+            ancestors = TrustClosure.objects.filter(descendant__in=trust_ids).values('ancestor')
+            entity_ids = set(get_entity_model().objects.filter(groups__trusts__in=ancestors).values_list('pk', flat=True))
+            entity_ids.update(TrustUserPermission.objects.filter(trust__in=ancestors).values_list('entity', flat=True))
+
+    return set(entity_ids), grants.get_descendant_ids(trust_ids)
+
+
+def trustuserpermission_changed(sender, instance, **kwargs):
+    if getattr(_local, 'bulk_depth', 0):
+        return
+    permissions_changed.send(sender=sender, trust_ids=[instance.trust_id], entity_ids=[instance.entity_id])
+
+
+def rolepermission_changed(sender, instance, **kwargs):
+    if getattr(_local, 'bulk_depth', 0):
+        return
+    permissions_changed.send(sender=sender, role_ids=[instance.role_id])
+
+
+def role_pre_delete(sender, instance, **kwargs):
+    # The role's group links are gone by the time post_delete is sent
+    instance._trusts_changed = {'group_ids': list(instance.groups.values_list('pk', flat=True))}
+
+
+def group_pre_delete(sender, instance, **kwargs):
+    entity_ids, trust_ids = resolve_affected(group_ids=[instance.pk])
+    instance._trusts_changed = {'entity_ids': entity_ids, 'trust_ids': trust_ids}
+
+
+def trust_pre_delete(sender, instance, **kwargs):
+    # The trust's grants are deleted, and their post_delete sent, before it
+    _local.deleted_trust_ids = get_deleted_trust_ids() | set([instance.pk])
+
+
+def trust_post_delete(sender, instance, **kwargs):
+    _local.deleted_trust_ids = get_deleted_trust_ids() - set([instance.pk])
+
+
+def stashed_post_delete(sender, instance, **kwargs):
+    changed = instance.__dict__.pop('_trusts_changed', None)
+    if changed:
+        permissions_changed.send(sender=sender, **changed)
+
+
+def connect_m2m_changed(field, source_kwarg, target_kwarg):
+    """
+    Forwards ``m2m_changed`` of a many-to-many ``field`` as
+    ``permissions_changed``, passing the pks of the source model as
+    ``source_kwarg`` and those of the target model as ``target_kwarg``.
+    """
+
+    through = field.rel.through
+    source_name = field.m2m_field_name()
+    target_name = field.m2m_reverse_field_name()
+
+    def m2m_changed(sender, instance, action, reverse, pk_set, **kwargs):
+        if reverse:
+            instance_name, others_name = target_name, source_name
+            instance_kwarg, others_kwarg = target_kwarg, source_kwarg
+        else:
+            instance_name, others_name = source_name, target_name
+            instance_kwarg, others_kwarg = source_kwarg, target_kwarg
+
+        if action == 'pre_clear':
+            instance._trusts_cleared_pks = set(through._default_manager.filter(
+                **{instance_name: instance.pk}).values_list(others_name, flat=True))
+            return
+        elif action == 'post_clear':
+            pk_set = instance.__dict__.pop('_trusts_cleared_pks', None)
+        elif action not in ('post_add', 'post_remove'):
+            return
+
+        if not pk_set:
+            return
+
+        changed = {}
+        if instance_kwarg is not None:
+            changed[instance_kwarg] = [instance.pk]
+        if others_kwarg is not None:
+            changed[others_kwarg] = list(pk_set)
+        permissions_changed.send(sender=sender, **changed)
+
+    signals.m2m_changed.connect(m2m_changed, sender=through, weak=False,
+            dispatch_uid='trusts_m2m_changed_%s' % through._meta.db_table)
+
+
+signals.post_save.connect(trustuserpermission_changed, sender=TrustUserPermission)
+signals.post_delete.connect(trustuserpermission_changed, sender=TrustUserPermission)
+signals.post_save.connect(rolepermission_changed, sender=RolePermission)
+signals.post_delete.connect(rolepermission_changed, sender=RolePermission)
+signals.pre_delete.connect(trust_pre_delete, sender=Trust)
+signals.post_delete.connect(trust_post_delete, sender=Trust)
+signals.pre_delete.connect(role_pre_delete, sender=Role)
+signals.post_delete.connect(stashed_post_delete, sender=Role)
+signals.pre_delete.connect(group_pre_delete, sender=get_group_model())
+signals.post_delete.connect(stashed_post_delete, sender=get_group_model())
+
+connect_m2m_changed(Trust._meta.get_field('groups'), 'trust_ids', 'group_ids')
+connect_m2m_changed(Role._meta.get_field('groups'), None, 'group_ids')
+connect_m2m_changed(get_group_model()._meta.get_field('permissions'), 'group_ids', None)
+try:
+    connect_m2m_changed(get_entity_model()._meta.get_field('groups'), 'entity_ids', 'group_ids')
+except FieldDoesNotExist:
+    pass
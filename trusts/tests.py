@@ -5,16 +5,18 @@ import unittest
 from decimal import Decimal
 from urllib import urlencode
 from urlparse import urlparse
+from StringIO import StringIO
 from datetime import date, datetime, timedelta
-from mock import Mock
+from mock import Mock, patch
 
 from django.apps import apps
 from django.db import models, connection, IntegrityError
 from django.db.models import F
 from django.db.models.base import ModelBase
 from django.conf import settings
-from django.core.exceptions import ValidationError
-from django.core.management import call_command
+from django.core.cache import caches
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.management import CommandError, call_command
 from django.core.management.color import no_style
 from django.contrib.auth.models import User, Group, Permission
 from django.contrib.auth.decorators import login_required
@@ -23,12 +25,21 @@ from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.management import update_contenttypes
 from django.test import TestCase, TransactionTestCase
 from django.test.client import MULTIPART_CONTENT, Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.http import Http404, HttpResponse
+from django.utils import timezone
 from django.http.request import HttpRequest
 
 from trusts.models import Trust, TrustManager, Content, Junction, \
-                          Role, RolePermission, TrustUserPermission
+                          Role, RolePermission, TrustUserPermission, EffectivePermission, TrustClosure
 from trusts.backends import TrustModelBackend
+from trusts import bitsets
+from trusts.cache import make_keys
 from trusts.decorators import permission_required, P, K, G, O
+from trusts.middleware import PermissionStatsMiddleware
+from trusts.signals import permission_checked, permissions_changed
+from trusts import utils
+from trusts.utils import get_short_model_name
 
 
 def create_test_users(test):
@@ -159,6 +170,403 @@ class TrustTest(TestCase):
         except ValidationError as ve:
             pass
 
+    def test_readonly_fields_snapshot(self):
+        self.trust1 = Trust(settlor=self.user, title='Title 0A', trust=Trust.objects.get_root())
+        self.trust1.save()
+        self.trust2 = Trust(settlor=self.user1, title='Title 1A', trust=self.trust1)
+        self.trust2.save()
+
+        # Loading trusts does not fetch their parent or settlor
+        with self.assertNumQueries(1):
+            trusts = list(Trust.objects.all())
+        with self.assertNumQueries(1):
+            trusts = list(Trust.objects.only('title').iterator())
+        self.assertEqual(len(trusts), 3)
+
+        trust = Trust.objects.get(pk=self.trust2.pk)
+        self.assertEqual(trust._state.init_fields, {'trust_id': self.trust1.pk, 'settlor_id': self.user1.pk})
+        self.assertEqual(Trust.objects.only('title').get(pk=self.trust2.pk)._state.init_fields, {})
+
+        trust.title = 'Title 1B'
+        trust.full_clean()
+        trust.trust_id = Trust.objects.get_root().pk
+        with self.assertRaisesRegexp(ValidationError, 'Field "trust" is readonly.'):
+            trust.full_clean()
+
+    @override_settings(TRUSTS_PERMISSION_CACHE='default')
+    def test_permission_cache_generations(self):
+        self.trust1 = Trust(settlor=self.user, title='Title 0A', trust=Trust.objects.get_root())
+        self.trust1.save()
+        self.trust2 = Trust(settlor=self.user, title='Title 0B', trust=Trust.objects.get_root())
+        self.trust2.save()
+        self.group = Group(name='Group A')
+        self.group.save()
+        trust_ids = [self.trust1.pk, self.trust2.pk]
+
+        keys = make_keys(self.user, trust_ids)
+        self.assertEqual(keys, make_keys(self.user, trust_ids))
+
+        # A trust change only orphans the entries of that trust
+        self.trust1.groups.add(self.group)
+        changed = make_keys(self.user, trust_ids)
+        self.assertNotEqual(keys[self.trust1.pk], changed[self.trust1.pk])
+        self.assertEqual(keys[self.trust2.pk], changed[self.trust2.pk])
+
+        # A membership change only orphans the entries of that user
+        keys, keys1 = changed, make_keys(self.user1, trust_ids)
+        self.user.groups.add(self.group)
+        changed = make_keys(self.user, trust_ids)
+        self.assertNotEqual(keys[self.trust1.pk], changed[self.trust1.pk])
+        self.assertNotEqual(keys[self.trust2.pk], changed[self.trust2.pk])
+        self.assertEqual(keys1, make_keys(self.user1, trust_ids))
+
+    @override_settings(TRUSTS_PERMISSION_CACHE='default')
+    def test_warm_trust_cache(self):
+        caches['default'].clear()
+        self.trust1 = Trust(settlor=self.user, title='Warm', trust=Trust.objects.get_root())
+        self.trust1.save()
+        self.trust2 = Trust(settlor=self.user, title='Warm content', trust=self.trust1)
+        self.trust2.save()
+        perm = Permission.objects.get_by_natural_key('change_trust', 'trusts', 'trust')
+        TrustUserPermission(trust=self.trust1, entity=self.user, permission=perm).save()
+        TrustUserPermission(trust=self.trust1, entity=self.user1, permission=perm).save()
+        User.objects.filter(pk=self.user.pk).update(last_login=timezone.now())
+        User.objects.filter(pk=self.user1.pk).update(last_login=timezone.now() - timedelta(days=30))
+
+        out = StringIO()
+        call_command('warm_trust_cache', chunk_size=1, stdout=out)
+        self.assertEqual(out.getvalue(), 'Stored 1 entries for 1 users.\n')
+
+        # The recently active user's permissions are found in the cache
+        perm_code = self.get_perm_code(perm)
+        bitsets.index.load()
+        reload_test_users(self)
+        with self.assertNumQueries(0):
+            self.assertTrue(self.user.has_perm(perm_code, self.trust2))
+        with self.assertNumQueries(1):
+            self.assertTrue(self.user1.has_perm(perm_code, self.trust2))
+
+        # A grant revoked while the permissions are loaded is not cached
+        from trusts import cache, grants
+        get_grants = grants.get_grants
+        def revoking_get_grants(*args, **kwargs):
+            rows = list(get_grants(*args, **kwargs))
+            TrustUserPermission.objects.filter(trust=self.trust1, entity=self.user).delete()
+            return rows
+        with patch('trusts.grants.get_grants', revoking_get_grants):
+            self.assertEqual(cache.warm([self.user]), 0)
+        reload_test_users(self)
+        self.assertFalse(self.user.has_perm(perm_code, self.trust2))
+
+        with self.settings(TRUSTS_PERMISSION_CACHE=None):
+            self.assertRaises(CommandError, call_command, 'warm_trust_cache')
+
+    @override_settings(TRUSTS_INHERIT_PERMISSIONS=True)
+    def test_inherited_permissions(self):
+        call_command('rebuild_trust_closure')
+        self.assertEqual(list(TrustClosure.objects.values_list('ancestor', 'descendant', 'depth')),
+                [(self.ROOT_PK, self.ROOT_PK, 0)])
+
+        self.trust1 = Trust(settlor=self.user, title='Parent', trust=Trust.objects.get_root())
+        self.trust1.save()
+        self.trust2 = Trust(settlor=self.user, title='Child', trust=self.trust1)
+        self.trust2.save()
+        self.trust3 = Trust(settlor=self.user, title='Grandchild', trust=self.trust2)
+        self.trust3.save()
+
+        def get_ancestors(trust):
+            return list(TrustClosure.objects.filter(descendant=trust).order_by('depth')
+                .values_list('ancestor', 'depth'))
+
+        self.assertEqual(get_ancestors(self.trust3),
+                [(self.trust3.pk, 0), (self.trust2.pk, 1), (self.trust1.pk, 2), (self.ROOT_PK, 3)])
+
+        perm = Permission.objects.get_by_natural_key('change_trust', 'trusts', 'trust')
+        perm_code = self.get_perm_code(perm)
+        TrustUserPermission(trust=self.trust1, entity=self.user, permission=perm).save()
+
+        # The grandchild trust is content of the child trust
+        qs = Trust.objects.filter(pk=self.trust3.pk)
+        reload_test_users(self)
+        bitsets.index.load()
+        with self.assertNumQueries(2):
+            self.assertTrue(self.user.has_perm(perm_code, qs))
+        self.assertEqual(set(Trust.objects.filter_by_user_permission(self.user, perm_code).values_list('pk', flat=True)),
+                set([self.trust1.pk, self.trust2.pk, self.trust3.pk]))
+
+        # Moving the child trust moves the grandchild with it
+        self.trust2.trust = Trust.objects.get_root()
+        self.trust2.save()
+        self.assertEqual(get_ancestors(self.trust3),
+                [(self.trust3.pk, 0), (self.trust2.pk, 1), (self.ROOT_PK, 2)])
+
+        reload_test_users(self)
+        self.assertFalse(self.user.has_perm(perm_code, qs))
+        self.assertEqual(set(Trust.objects.filter_by_user_permission(self.user, perm_code).values_list('pk', flat=True)),
+                set([self.trust1.pk]))
+
+        with self.settings(TRUSTS_EFFECTIVE_PERMISSIONS=True):
+            call_command('rebuild_effective_permissions')
+            self.trust3.trust = self.trust1
+            self.trust3.save()
+            self.assertTrue(EffectivePermission.objects.filter(entity=self.user, trust=self.trust3).exists())
+            reload_test_users(self)
+            self.assertTrue(self.user.has_perm(perm_code, qs))
+
+        call_command('rebuild_trust_closure', chunk_size=1)
+        self.assertEqual(get_ancestors(self.trust3), [(self.trust3.pk, 0), (self.trust1.pk, 1), (self.ROOT_PK, 2)])
+
+    @override_settings(TRUSTS_INHERIT_PERMISSIONS=True)
+    def test_transfer_contents(self):
+        call_command('rebuild_trust_closure')
+        self.trust1 = Trust(settlor=self.user, title='From', trust=Trust.objects.get_root())
+        self.trust1.save()
+        self.trust2 = Trust(settlor=self.user, title='To', trust=Trust.objects.get_root())
+        self.trust2.save()
+        children = []
+        for i in range(3):
+            children.append(Trust(settlor=self.user, title='Child %d' % i, trust=self.trust1))
+            children[-1].save()
+        grandchild = Trust(settlor=self.user, title='Grandchild', trust=children[0])
+        grandchild.save()
+
+        perm = Permission.objects.get_by_natural_key('change_trust', 'trusts', 'trust')
+        TrustUserPermission(trust=self.trust2, entity=self.user, permission=perm).save()
+        reload_test_users(self)
+        self.assertFalse(self.user.has_perm(self.get_perm_code(perm), Trust.objects.filter(pk=grandchild.pk)))
+
+        events = []
+        def receiver(sender, **kwargs):
+            events.append(kwargs)
+
+        permissions_changed.connect(receiver)
+        try:
+            moved = Trust.objects.transfer_contents(Trust.objects.filter(title__startswith='Child'),
+                self.trust1, self.trust2, chunk_size=2)
+        finally:
+            permissions_changed.disconnect(receiver)
+
+        self.assertEqual(moved, 3)
+        self.assertEqual(set(Trust.objects.filter(trust=self.trust2).values_list('pk', flat=True)),
+                set([child.pk for child in children]))
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['trust_ids'], set([self.trust1.pk, self.trust2.pk, grandchild.pk] +
+                [child.pk for child in children]))
+        self.assertEqual(list(TrustClosure.objects.filter(descendant=grandchild).order_by('depth')
+                .values_list('ancestor', flat=True)), [grandchild.pk, children[0].pk, self.trust2.pk, self.ROOT_PK])
+
+        reload_test_users(self)
+        self.assertTrue(self.user.has_perm(self.get_perm_code(perm), Trust.objects.filter(pk=grandchild.pk)))
+
+        # Ordinary saves still may not change the trust
+        child = Trust.objects.get(pk=children[1].pk)
+        child.trust = self.trust1
+        self.assertRaises(ValidationError, child.full_clean)
+
+        with self.assertRaises(ValueError):
+            Trust.objects.transfer_contents(Trust, self.trust2, grandchild)
+        self.assertEqual(Trust.objects.filter(trust=self.trust2).count(), 3)
+        self.assertEqual(Trust.objects.transfer_contents(Trust, self.trust1, self.trust2), 0)
+        self.assertRaises(TypeError, Trust.objects.transfer_contents, User, self.trust1, self.trust2)
+
+    @override_settings(TRUSTS_EFFECTIVE_PERMISSIONS=True)
+    def test_delete_trust_effective_permissions(self):
+        self.trust = Trust(settlor=self.user, title='Deleted', trust=Trust.objects.get_root())
+        self.trust.save()
+        group = Group(name='Deleted trust group')
+        group.save()
+        perm_read, perm_change = Permission.objects.all()[:2]
+        group.permissions.add(perm_read)
+        self.user.groups.add(group)
+        self.trust.groups.add(group)
+        TrustUserPermission(trust=self.trust, entity=self.user, permission=perm_change).save()
+        self.assertEqual(EffectivePermission.objects.filter(trust=self.trust).count(), 2)
+
+        # The grants' post_delete must not refresh the trust being deleted
+        trust_pk = self.trust.pk
+        self.trust.delete()
+        self.assertFalse(EffectivePermission.objects.filter(trust=trust_pk).exists())
+
+    def test_transfer_contents_cycle(self):
+        root = Trust.objects.get_root()
+        self.trust1 = Trust(settlor=self.user, title='A', trust=root)
+        self.trust1.save()
+        self.trust2 = Trust(settlor=self.user, title='B', trust=self.trust1)
+        self.trust2.save()
+        self.trust3 = Trust(settlor=self.user, title='C', trust=self.trust2)
+        self.trust3.save()
+
+        # Rejected without the closure table as well
+        for to_trust in (self.trust2, self.trust3):
+            with self.assertRaises(ValueError):
+                Trust.objects.transfer_contents(Trust.objects.filter(pk=self.trust1.pk), root, to_trust)
+        self.assertEqual(Trust.objects.filter(pk=self.trust1.pk).values_list('trust', flat=True)[0], root.pk)
+
+        self.assertEqual(Trust.objects.transfer_contents(Trust.objects.filter(pk=self.trust3.pk), self.trust2,
+            self.trust1), 1)
+        self.assertEqual(Trust.objects.filter(pk=self.trust3.pk).values_list('trust', flat=True)[0], self.trust1.pk)
+
+    def test_permission_checked(self):
+        self.trust1 = Trust(settlor=self.user, title='Checked', trust=Trust.objects.get_root())
+        self.trust1.save()
+        perm = Permission.objects.get_by_natural_key('change_trust', 'trusts', 'trust')
+        TrustUserPermission(trust=self.trust1, entity=self.user, permission=perm).save()
+        self.trust2 = Trust(settlor=self.user, title='Checked content', trust=self.trust1)
+        self.trust2.save()
+        qs = Trust.objects.filter(pk=self.trust2.pk)
+
+        checks = []
+        def receiver(sender, **kwargs):
+            checks.append(kwargs)
+
+        permission_checked.connect(receiver)
+        try:
+            reload_test_users(self)
+            self.assertTrue(self.user.has_perm(self.get_perm_code(perm), qs))
+            self.assertTrue(self.user.has_perm(self.get_perm_code(perm), qs))
+        finally:
+            permission_checked.disconnect(receiver)
+
+        self.assertEqual(len(checks), 2)
+        self.assertEqual([check['result'] for check in checks], [True, True])
+        self.assertEqual([(check['hits'], check['misses']) for check in checks],
+                [([], [self.trust1.pk]), ([self.trust1.pk], [])])
+        self.assertTrue(checks[0]['duration'] >= 0)
+
+        middleware = PermissionStatsMiddleware()
+        request = HttpRequest()
+        request.method, request.path = 'GET', '/receipts/'
+        with self.settings(DEBUG=True):
+            middleware.process_request(request)
+            reload_test_users(self)
+            self.user.has_perm(self.get_perm_code(perm), qs)
+            self.user.has_perm(self.get_perm_code(perm), qs)
+            response = middleware.process_response(request, HttpResponse())
+        self.assertTrue(response['X-Trusts-Permission-Checks'].startswith('checks=2; hits=1; misses=1; queries='))
+
+        middleware.process_request(request)
+        response = middleware.process_response(request, HttpResponse())
+        self.assertFalse(response.has_header('X-Trusts-Permission-Checks'))
+
+    def test_content_registry(self):
+        proxy = ModelBase(str('TrustProxy'), (Trust, ), {
+            '__module__': Trust.__module__, 'Meta': type(str('Meta'), (), {'proxy': True})})
+        try:
+            self.assertTrue(Content.is_content_model(proxy))
+            self.assertIsNone(Content.get_content_fieldlookup(proxy))
+            self.assertFalse(Content.is_content_model(User))
+
+            # Conditions are resolved through the base classes
+            own = Content.get_permission_condition_func(Trust, 'own')
+            self.assertIsNotNone(own)
+            self.assertIs(Content.get_permission_condition_func(proxy, 'own'), own)
+            self.assertIsNone(Content.get_permission_condition_func(proxy, 'shared'))
+
+            shared = lambda u, p, o: True
+            Content.register_permission_condition(Trust, 'shared', shared)
+            self.assertIs(Content.get_permission_condition_func(proxy, 'shared'), shared)
+        finally:
+            Content._conditions['trusts.Trust'].pop('shared', None)
+            Content.clear_cache()
+            apps.get_app_config('trusts').models.pop('trustproxy')
+
+        self.assertEqual(utils.parse_perm_code('trusts.change_trust:own'), ('trusts', 'trust', 'change', 'own'))
+        self.assertIs(utils.parse_perm_code('trusts.change_trust:own'), utils.parse_perm_code('trusts.change_trust:own'))
+
+    def test_grant_many(self):
+        self.trust1 = Trust(settlor=self.user, title='Bulk 1', trust=Trust.objects.get_root())
+        self.trust1.save()
+        self.trust2 = Trust(settlor=self.user, title='Bulk 2', trust=Trust.objects.get_root())
+        self.trust2.save()
+        self.group = Group.objects.create(name='Bulk')
+        perms = list(Permission.objects.filter(content_type__app_label='trusts')[:2])
+        TrustUserPermission(trust=self.trust1, entity=self.user, permission=perms[0]).save()
+
+        events = []
+        def receiver(sender, **kwargs):
+            events.append(kwargs)
+
+        grants = [(trust, user, perm) for trust in (self.trust1, self.trust2.pk)
+                for user in (self.user, self.user1) for perm in perms]
+        permissions_changed.connect(receiver)
+        try:
+            # Existing grants are skipped, so that a retry is harmless
+            self.assertEqual(TrustUserPermission.objects.grant_many(grants, chunk_size=3), 7)
+            self.assertEqual(TrustUserPermission.objects.grant_many(grants), 0)
+            self.assertEqual(Trust.objects.grant_many([(self.trust1, self.group), (self.trust2, self.group.pk)]), 2)
+            self.assertEqual(Trust.objects.grant_many([(self.trust1, self.group)]), 0)
+        finally:
+            permissions_changed.disconnect(receiver)
+
+        self.assertEqual(TrustUserPermission.objects.filter(trust__in=[self.trust1, self.trust2]).count(), 8)
+        self.assertEqual(set(self.group.trusts.values_list('pk', flat=True)), set([self.trust1.pk, self.trust2.pk]))
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events[0]['trust_ids'], set([self.trust1.pk, self.trust2.pk]))
+        self.assertEqual(events[0]['entity_ids'], set([self.user.pk, self.user1.pk]))
+        self.assertEqual(events[1]['group_ids'], set([self.group.pk]))
+
+        self.assertIn(self.trust2.pk, Trust.objects.filter_by_user_permission(self.user1,
+                self.get_perm_code(perms[1])).values_list('pk', flat=True))
+
+        del events[:]
+        permissions_changed.connect(receiver)
+        try:
+            self.assertEqual(TrustUserPermission.objects.revoke_many(grants[4:], chunk_size=3), 4)
+            self.assertEqual(TrustUserPermission.objects.revoke_many(grants[4:]), 0)
+            self.assertEqual(Trust.objects.revoke_many([(self.trust2, self.group)]), 1)
+        finally:
+            permissions_changed.disconnect(receiver)
+        # The deleted rows do not send their own post_delete change
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events[0]['trust_ids'], set([self.trust2.pk]))
+        self.assertEqual(events[0]['entity_ids'], set([self.user.pk, self.user1.pk]))
+        self.assertEqual(TrustUserPermission.objects.filter(trust__in=[self.trust1, self.trust2]).count(), 4)
+        self.assertEqual(list(self.group.trusts.values_list('pk', flat=True)), [self.trust1.pk])
+
+        self.assertNotIn(self.trust2.pk, Trust.objects.filter_by_user_permission(self.user1,
+                self.get_perm_code(perms[1])).values_list('pk', flat=True))
+
+    @unittest.skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is specific to SQLite')
+    def test_grant_query_plans(self):
+        from trusts import grants
+
+        plans = []
+        for trust_ids in ([self.ROOT_PK], None):
+            for qs in grants.get_grant_querysets([self.user.pk], trust_ids):
+                sql, params = qs.order_by().query.sql_with_params()
+                with connection.cursor() as cursor:
+                    cursor.execute('EXPLAIN QUERY PLAN %s' % sql, params)
+                    plans.extend([row[-1] for row in cursor.fetchall()])
+
+        self.assertEqual([plan for plan in plans if plan.startswith('SCAN')], [])
+        for index in ('trusts_trust_groups_group_trust', 'trusts_role_groups_group_role',
+                'trusts_trustuserpermission_entity_id_'):
+            self.assertTrue([plan for plan in plans if 'COVERING INDEX %s' % index in plan], index)
+
+    def test_permission_index(self):
+        perms = list(Permission.objects.all()[:3])
+        codes = set([self.get_perm_code(perm) for perm in perms])
+        mask = bitsets.to_mask([perm.pk for perm in perms])
+
+        bitsets.index.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(bitsets.index.to_codes(mask), codes)
+        with self.assertNumQueries(0):
+            self.assertEqual(bitsets.index.get_bit(self.get_perm_code(perms[0])), 1 << perms[0].pk)
+            self.assertEqual(bitsets.index.to_codes(0), set())
+        # An unknown code reloads the index only once
+        with self.assertNumQueries(1):
+            for i in range(5):
+                self.assertEqual(bitsets.index.get_bit('trusts.no_such_permission'), 0)
+
+        # New permissions are found after reloading the index
+        perm = Permission.objects.create(codename='index_trust', name='Index trust',
+                content_type=ContentType.objects.get_for_model(Trust))
+        self.assertEqual(bitsets.index.get_bit('trusts.index_trust'), 1 << perm.pk)
+        perm = Permission.objects.create(codename='no_such_permission', name='No such permission',
+                content_type=ContentType.objects.get_for_model(Trust))
+        self.assertEqual(bitsets.index.get_bit('trusts.no_such_permission'), 1 << perm.pk)
+
 class DecoratorsTest(TestCase):
     def setUp(self):
         super(DecoratorsTest, self).setUp()
@@ -588,6 +996,340 @@ class TrustContentTestMixin(ContentModel):
 
         self.assertFalse(had)
 
+    def test_has_perm_queryset_many_trusts_num_queries(self):
+        contents = []
+        for i in range(5):
+            trust = Trust(settlor=self.user, title='Title %s' % i, trust=Trust.objects.get_root())
+            trust.save()
+            contents.append(self.create_content(trust))
+
+            tup = TrustUserPermission(trust=trust, entity=self.user, permission=self.perm_change)
+            tup.save()
+
+        reload_test_users(self)
+        content_model = self.content_model if hasattr(self, 'content_model') else self.model
+        qs = content_model.objects.filter(pk__in=[c.pk for c in contents])
+        perm_change = self.get_perm_code(self.perm_change)
+        perm_delete = self.get_perm_code(self.perm_delete)
+
+        def count_perm_queries(queries):
+            return len([q for q in queries if 'auth_permission' in q['sql']])
+
+        # The permission index is loaded once per process
+        bitsets.index.load()
+
+        with CaptureQueriesContext(connection) as queries:
+            had = self.user.has_perm(perm_change, qs)
+        self.assertTrue(had)
+        self.assertEqual(count_perm_queries(queries), 1)
+
+        with CaptureQueriesContext(connection) as queries:
+            had = self.user.has_perm(perm_delete, qs)
+        self.assertFalse(had)
+        self.assertEqual(count_perm_queries(queries), 0)
+
+    def test_get_trusts(self):
+        self.trust = Trust(settlor=self.user, trust=Trust.objects.get_root(), title='trust 1')
+        self.trust.save()
+        self.trust1 = Trust(settlor=self.user, trust=Trust.objects.get_root(), title='trust 2')
+        self.trust1.save()
+        self.content = self.create_content(self.trust)
+        self.content1 = self.create_content(self.trust1)
+        self.content2 = self.create_content(self.trust1)
+
+        # Content with a trust field needs no query
+        with self.assertNumQueries(1 if issubclass(self.model, Junction) else 0):
+            trust_ids = TrustModelBackend._get_trusts(self.content)
+        self.assertEqual(trust_ids, [self.trust.pk])
+
+        content_model = self.content_model if hasattr(self, 'content_model') else self.model
+        qs = content_model.objects.filter(pk__in=[self.content.pk, self.content1.pk, self.content2.pk])
+        with self.assertNumQueries(1):
+            trust_ids = TrustModelBackend._get_trusts(qs)
+        self.assertEqual(sorted(trust_ids), sorted([self.trust.pk, self.trust1.pk]))
+
+    def test_permitted(self):
+        trusts = []
+        for i in range(4):
+            trust = Trust(settlor=self.user, title='Title %s' % i, trust=Trust.objects.get_root())
+            trust.save()
+            trusts.append(trust)
+        contents = [self.create_content(trust) for trust in trusts]
+
+        # Direct grant
+        TrustUserPermission(trust=trusts[0], entity=self.user, permission=self.perm_read).save()
+
+        # Group grant
+        self.group.permissions.add(self.perm_read)
+        self.group.user_set.add(self.user)
+        trusts[1].groups.add(self.group)
+
+        # Role grant
+        group = Group(name='Role Group')
+        group.save()
+        group.user_set.add(self.user)
+        trusts[2].groups.add(group)
+        role = Role(name='reader')
+        role.save()
+        role.groups.add(group)
+        RolePermission(role=role, permission=self.perm_read).save()
+
+        # Grant of another permission
+        TrustUserPermission(trust=trusts[3], entity=self.user, permission=self.perm_change).save()
+
+        if issubclass(self.model, Junction):
+            qs = self.model.permitted(self.user, 'read')
+        else:
+            qs = self.model.objects.permitted(self.user, 'read')
+
+        with self.assertNumQueries(1):
+            pks = set(qs.values_list('pk', flat=True))
+        self.assertEqual(pks, set([c.pk for c in contents[:3]]))
+
+        if issubclass(self.model, Junction):
+            qs = self.model.permitted(self.user1, 'read')
+        else:
+            qs = self.model.objects.permitted(self.user1, 'read')
+        self.assertEqual(qs.count(), 0)
+
+    def test_has_perm_num_queries(self):
+        self.trust = Trust(settlor=self.user, trust=Trust.objects.get_root(), title='trust 1')
+        self.trust.save()
+        self.content = self.create_content(self.trust)
+        self.content1 = self.create_content(self.trust)
+
+        # Many permissions granted through every branch
+        perms = list(Permission.objects.exclude(pk=self.perm_change.pk)[:40])
+        for perm in perms:
+            TrustUserPermission(trust=self.trust, entity=self.user, permission=perm).save()
+        self.group.permissions.add(*perms)
+        self.group.user_set.add(self.user)
+        self.trust.groups.add(self.group)
+        role = Role(name='many')
+        role.save()
+        role.groups.add(self.group)
+        for perm in perms:
+            RolePermission(role=role, permission=perm).save()
+        TrustUserPermission(trust=self.trust, entity=self.user, permission=self.perm_change).save()
+
+        perm_change = self.get_perm_code(self.perm_change)
+        perm_delete = self.get_perm_code(self.perm_delete)
+        content_model = self.content_model if hasattr(self, 'content_model') else self.model
+        qs = content_model.objects.filter(pk__in=[self.content.pk, self.content1.pk])
+
+        # Junction content needs a query to resolve its trust
+        trust_queries = 1 if issubclass(self.model, Junction) else 0
+        bitsets.index.load()
+
+        reload_test_users(self)
+        with self.assertNumQueries(trust_queries + 1):
+            self.assertTrue(self.user.has_perm(perm_change, self.content))
+        with self.assertNumQueries(trust_queries):
+            self.assertTrue(self.user.has_perm(perm_change, self.content1))
+        with self.assertNumQueries(trust_queries):
+            self.assertEqual(self.user.has_perm(perm_delete, self.content1), self.perm_delete in perms)
+
+        reload_test_users(self)
+        with self.assertNumQueries(2):
+            self.assertTrue(self.user.has_perm(perm_change, qs))
+        with self.assertNumQueries(1):
+            self.assertTrue(self.user.has_perm(perm_change, qs))
+
+        with self.assertNumQueries(trust_queries + 1):
+            group_perms = TrustModelBackend().get_group_permissions(self.user, self.content)
+        self.assertEqual(group_perms, set([self.get_perm_code(perm) for perm in perms]))
+
+    def test_has_perm_many(self):
+        trusts = []
+        for i in range(3):
+            trust = Trust(settlor=self.user, title='Title %s' % i, trust=Trust.objects.get_root())
+            trust.save()
+            trusts.append(trust)
+        contents = [self.create_content(trusts[0]), self.create_content(trusts[0]),
+                    self.create_content(trusts[1]), self.create_content(trusts[2])]
+
+        TrustUserPermission(trust=trusts[0], entity=self.user, permission=self.perm_change).save()
+        TrustUserPermission(trust=trusts[2], entity=self.user, permission=self.perm_change).save()
+
+        perm_change = self.get_perm_code(self.perm_change)
+        content_model = self.content_model if hasattr(self, 'content_model') else self.model
+        expected = {contents[0].pk: True, contents[1].pk: True, contents[2].pk: False, contents[3].pk: True}
+        backend = TrustModelBackend()
+        bitsets.index.load()
+
+        # Content with a trust field needs no query to resolve its trusts
+        reload_test_users(self)
+        with self.assertNumQueries(2 if issubclass(self.model, Junction) else 1):
+            self.assertEqual(backend.has_perm_many(self.user, perm_change, contents), expected)
+
+        # Junction content also needs the pks of a QuerySet without a trust
+        reload_test_users(self)
+        qs = content_model.objects.filter(pk__in=expected.keys())
+        with self.assertNumQueries(3 if issubclass(self.model, Junction) else 2):
+            self.assertEqual(backend.has_perm_many(self.user, perm_change, qs), expected)
+        with self.assertNumQueries(2 if issubclass(self.model, Junction) else 1):
+            self.assertEqual(backend.has_perm_many(self.user, perm_change, qs), expected)
+
+        self.assertEqual(backend.has_perm_many(self.user1, perm_change, contents),
+                {content.pk: False for content in contents})
+        self.assertEqual(backend.has_perm_many(self.user, perm_change, []), {})
+
+        # Condition is only evaluated on permitted objects
+        checked = []
+        def condition(user, perm, obj):
+            checked.append(obj.pk)
+            return obj.pk != contents[0].pk
+
+        Content.register_permission_condition(content_model, 'many', condition)
+        try:
+            results = backend.has_perm_many(self.user, '%s:many' % perm_change, qs)
+        finally:
+            del Content._conditions[get_short_model_name(content_model)]['many']
+            Content.clear_cache()
+        expected[contents[0].pk] = False
+        self.assertEqual(results, expected)
+        self.assertEqual(sorted(checked), sorted([contents[0].pk, contents[1].pk, contents[3].pk]))
+
+    @override_settings(TRUSTS_PRELOAD_PERMISSIONS=True)
+    def test_preload_permissions(self):
+        trusts = []
+        for i in range(3):
+            trust = Trust(settlor=self.user, title='Title %s' % i, trust=Trust.objects.get_root())
+            trust.save()
+            trusts.append(trust)
+        contents = [self.create_content(trust) for trust in trusts]
+
+        TrustUserPermission(trust=trusts[0], entity=self.user, permission=self.perm_change).save()
+        self.group.permissions.add(self.perm_change)
+        self.group.user_set.add(self.user)
+        trusts[1].groups.add(self.group)
+
+        perm_change = self.get_perm_code(self.perm_change)
+        trust_queries = 1 if issubclass(self.model, Junction) else 0
+        bitsets.index.load()
+
+        # Permissions on all trusts are loaded by the first check
+        reload_test_users(self)
+        with self.assertNumQueries(trust_queries + 1):
+            self.assertTrue(self.user.has_perm(perm_change, contents[0]))
+        with self.assertNumQueries(trust_queries):
+            self.assertTrue(self.user.has_perm(perm_change, contents[1]))
+        with self.assertNumQueries(trust_queries):
+            self.assertFalse(self.user.has_perm(perm_change, contents[2]))
+
+    @override_settings(TRUSTS_EFFECTIVE_PERMISSIONS=True)
+    def test_effective_permissions(self):
+        self.trust = Trust(settlor=self.user, trust=Trust.objects.get_root(), title='effective')
+        self.trust.save()
+        self.content = self.create_content(self.trust)
+        perm_change = self.get_perm_code(self.perm_change)
+        perm_read = self.get_perm_code(self.perm_read)
+
+        def get_effective_perms():
+            return set(EffectivePermission.objects.filter(entity=self.user, trust=self.trust)
+                .values_list('permission', flat=True))
+
+        # Direct grant
+        tup = TrustUserPermission(trust=self.trust, entity=self.user, permission=self.perm_change)
+        tup.save()
+        self.assertEqual(get_effective_perms(), set([self.perm_change.pk]))
+
+        # Role grant
+        role = Role(name='reader')
+        role.save()
+        RolePermission(role=role, permission=self.perm_read).save()
+        role.groups.add(self.group)
+        self.trust.groups.add(self.group)
+        self.assertEqual(get_effective_perms(), set([self.perm_change.pk]))
+
+        self.user.groups.add(self.group)
+        self.assertEqual(get_effective_perms(), set([self.perm_change.pk, self.perm_read.pk]))
+
+        reload_test_users(self)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(self.user.has_perm(perm_read, self.content))
+        self.assertTrue(any(['trusts_effectivepermission' in q['sql'] for q in queries]))
+        self.assertFalse(any(['trusts_rolepermission' in q['sql'] for q in queries]))
+
+        tup.delete()
+        self.group.user_set.remove(self.user)
+        self.assertEqual(get_effective_perms(), set())
+
+        reload_test_users(self)
+        self.assertFalse(self.user.has_perm(perm_change, self.content))
+
+        # Rebuild from scratch
+        self.user.groups.add(self.group)
+        TrustUserPermission(trust=self.trust, entity=self.user, permission=self.perm_change).save()
+        EffectivePermission.objects.all().delete()
+        call_command('rebuild_effective_permissions', chunk_size=1)
+        self.assertEqual(get_effective_perms(), set([self.perm_change.pk, self.perm_read.pk]))
+
+    @override_settings(TRUSTS_PERMISSION_CACHE='default')
+    def test_shared_cache(self):
+        caches['default'].clear()
+
+        self.trust = Trust(settlor=self.user, trust=Trust.objects.get_root(), title='cached')
+        self.trust.save()
+        self.content = self.create_content(self.trust)
+        perm_change = self.get_perm_code(self.perm_change)
+        perm_delete = self.get_perm_code(self.perm_delete)
+
+        self.assertFalse(self.user.has_perm(perm_change, self.content))
+
+        reload_test_users(self)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertFalse(self.user.has_perm(perm_change, self.content))
+        self.assertEqual(len([q for q in queries if 'auth_permission' in q['sql']]), 0)
+
+        # Direct grant
+        tup = TrustUserPermission(trust=self.trust, entity=self.user, permission=self.perm_change)
+        tup.save()
+
+        reload_test_users(self)
+        self.assertTrue(self.user.has_perm(perm_change, self.content))
+
+        tup.delete()
+
+        reload_test_users(self)
+        self.assertFalse(self.user.has_perm(perm_change, self.content))
+
+        # Group grant, through both sides of the trust and user relations
+        self.group.permissions.add(self.perm_delete)
+        self.group.trusts.add(self.trust)
+
+        reload_test_users(self)
+        self.assertFalse(self.user.has_perm(perm_delete, self.content))
+
+        self.user.groups.add(self.group)
+
+        reload_test_users(self)
+        self.assertTrue(self.user.has_perm(perm_delete, self.content))
+
+        self.trust.groups.clear()
+
+        reload_test_users(self)
+        self.assertFalse(self.user.has_perm(perm_delete, self.content))
+
+        # Role grant
+        self.trust.groups.add(self.group)
+        role = Role(name='cached role')
+        role.save()
+        role.groups.add(self.group)
+
+        reload_test_users(self)
+        self.assertFalse(self.user.has_perm(perm_change, self.content))
+
+        RolePermission(role=role, permission=self.perm_change).save()
+
+        reload_test_users(self)
+        self.assertTrue(self.user.has_perm(perm_change, self.content))
+
+        role.delete()
+
+        reload_test_users(self)
+        self.assertFalse(self.user.has_perm(perm_change, self.content))
+
     def test_read_permissions_added(self):
         ct = ContentType.objects.get_for_model(self.model)
         self.assertIsNotNone(Permission.objects.get(
@@ -807,6 +1549,44 @@ class RoleTestMixin(object):
         rp = RolePermission.objects.filter(permission__content_type__app_label=self.app_label)
         self.assertEqual(rp.count(), 7)
 
+    def test_management_command_dry_run(self):
+        call_command('update_roles_permissions')
+        self.remove_model_roles('write')
+        self.append_model_roles('read', (self.get_perm_codename('read'), ))
+        rps = set(RolePermission.objects.values_list('role__name', 'permission_id'))
+
+        out = StringIO()
+        with patch('sys.stdout', out):
+            call_command('update_roles_permissions', dry_run=True)
+        self.assertIn('Adding role "read"', out.getvalue())
+        self.assertIn('Removing role "write"', out.getvalue())
+        self.assertEqual(set(RolePermission.objects.values_list('role__name', 'permission_id')), rps)
+        self.assertFalse(Role.objects.filter(name='read').exists())
+
+        # The number of queries does not depend on the number of roles
+        with self.assertNumQueries(14):
+            call_command('update_roles_permissions', verbosity=0)
+        self.assertTrue(Role.objects.filter(name='read').exists())
+        self.assertFalse(Role.objects.filter(name='write').exists())
+        with self.assertNumQueries(4):
+            call_command('update_roles_permissions', verbosity=0)
+
+    @override_settings(TRUSTS_EFFECTIVE_PERMISSIONS=True)
+    def test_management_command_effective_num_queries(self):
+        call_command('update_roles_permissions')
+        group = Group.objects.create(name='Roles')
+        Role.objects.get(name='write').groups.add(group)
+        self.user.groups.add(group)
+        self.trust = Trust(settlor=self.user, trust=Trust.objects.get_root(), title='roles')
+        self.trust.save()
+        self.trust.groups.add(group)
+        self.remove_model_roles('write')
+
+        # Deleted role permissions are refreshed once, not once per row
+        with self.assertNumQueries(25):
+            call_command('update_roles_permissions', verbosity=0)
+        self.assertFalse(RolePermission.objects.filter(role__name='write').exists())
+
 
 class TrustJunctionTestCase(TrustContentTestMixin, JunctionModelMixin, TransactionTestCase):
     @unittest.expectedFailure
@@ -879,6 +1659,145 @@ class DecoratorExpressionTest(ContentModelMixin, TestCase):
         permission_required(p, raise_exception=False)(mock)(self.request, pk=self.content2.pk)
         self.assertFalse(mock.called)
 
+    def test_explain_permission(self):
+        group = Group.objects.create(name='Explained')
+        group.permissions.add(self.perm_change)
+        self.user.groups.add(group)
+        self.trust1.groups.add(group)
+        model = '%s.%s' % (self.app_label, self.model_name)
+
+        def explain(perm, pk):
+            out = StringIO()
+            call_command('explain_permission', self.user.username, self.get_perm_code(perm), model, str(pk),
+                stdout=out)
+            return out.getvalue()
+
+        out = explain(self.perm_change, self.content1.pk)
+        self.assertIn('Trusts: %s\n' % self.trust1.pk, out)
+        self.assertIn('  trust %s: group, trustee\n' % self.trust1.pk, out)
+        self.assertIn('Result: granted in ', out)
+        self.assertIn('Queries: ', out)
+        self.assertIn('SELECT', out)
+
+        out = explain(self.perm_delete, self.content2.pk)
+        self.assertIn('  trust %s: not granted\n' % self.trust2.pk, out)
+        self.assertIn('Result: denied in ', out)
+
+        # The result is the user's, as decided by all backends
+        User.objects.filter(pk=self.user.pk).update(is_superuser=True)
+        out = explain(self.perm_delete, self.content2.pk)
+        self.assertIn('  trust %s: not granted\n' % self.trust2.pk, out)
+        self.assertIn('Result: granted in ', out)
+
+        with self.assertRaises(CommandError):
+            explain(self.perm_change, -1)
+        for perm in ('%s:nosuch' % self.get_perm_code(self.perm_change), 'garbage'):
+            with self.assertRaises(CommandError):
+                call_command('explain_permission', self.user.username, perm, model, str(self.content1.pk),
+                    stdout=StringIO())
+
+    def test_single_query(self):
+        perm_change = self.get_perm_code(self.perm_change)
+        perm_delete = self.get_perm_code(self.perm_delete)
+        ContentType.objects.get_by_natural_key(self.app_label, self.model_name)
+
+        def call(perm, pk, user=None):
+            self.request.user = user or self.user
+            mock = Mock(return_value='Response')
+            permission_required(perm, raise_exception=False, single_query=True,
+                fieldlookups_kwargs={'pk': 'pk'})(mock)(self.request, pk=pk)
+            return mock.called
+
+        with self.assertNumQueries(1):
+            self.assertTrue(call(perm_change, self.content1.pk))
+        with self.assertNumQueries(1):
+            self.assertFalse(call(perm_delete, self.content2.pk))
+        self.assertTrue(call(perm_delete, self.content1.pk))
+        self.assertFalse(call(perm_change, -1))
+        self.assertFalse(call(perm_change, self.content1.pk, self.user1))
+
+        p = P(perm_delete, fieldlookups_kwargs={'pk': 'pk'}) | P(perm_change, fieldlookups_kwargs={'pk': 'pk'})
+        self.assertTrue(call(p, self.content2.pk))
+
+        # Objects of other models are denied rather than looked up by trust
+        self.assertFalse(call('auth.change_permission', self.perm_change.pk))
+
+    def test_attach(self):
+        perm_change = self.get_perm_code(self.perm_change)
+        perm_delete = self.get_perm_code(self.perm_delete)
+        bitsets.index.load()
+        self.request.user = self.user
+
+        def view(request, pk):
+            return request.trusts_objects['content'][0]
+
+        decorated = permission_required(perm_change, raise_exception=False, attach='content',
+            fieldlookups_kwargs={'pk': 'pk'})(view)
+        # The objects are fetched once, and their trusts read from them
+        with self.assertNumQueries(2):
+            obj = decorated(self.request, pk=self.content1.pk)
+        self.assertEqual(obj, self.content1)
+        self.assertEqual(list(self.request.trusts_objects['content']), [self.content1])
+
+        # Nor fetched again to check a condition
+        checked = []
+        def condition(user, perm, obj):
+            checked.append(obj.pk)
+            return True
+
+        Content.register_permission_condition(self.model, 'attached', condition)
+        try:
+            decorated = permission_required('%s:attached' % perm_change, raise_exception=False, attach='content',
+                fieldlookups_kwargs={'pk': 'pk'})(view)
+            self.request.user = User._default_manager.get(pk=self.user.pk)
+            with self.assertNumQueries(2):
+                self.assertEqual(decorated(self.request, pk=self.content1.pk), self.content1)
+        finally:
+            del Content._conditions[get_short_model_name(self.model)]['attached']
+            Content.clear_cache()
+        self.assertEqual(checked, [self.content1.pk])
+
+        self.request.trusts_objects = {}
+        mock = Mock(return_value='Response')
+        permission_required(perm_delete, raise_exception=False, attach='content',
+            fieldlookups_kwargs={'pk': 'pk'})(mock)(self.request, pk=self.content2.pk)
+        self.assertFalse(mock.called)
+        self.assertEqual(self.request.trusts_objects, {})
+
+    def test_single_query_P(self):
+        perm_change = self.get_perm_code(self.perm_change)
+        perm_delete = self.get_perm_code(self.perm_delete)
+        ContentType.objects.get_by_natural_key(self.app_label, self.model_name)
+
+        def call(p, pk, content):
+            self.request.user = self.user
+            self.request.GET = {'content': content}
+            mock = Mock(return_value='Response')
+            permission_required(p, raise_exception=False, single_query=True)(mock)(self.request, pk=pk)
+            return mock.called
+
+        p = (P(perm_delete, pk=K('pk')) & P(perm_change, pk=G('content'))) | P(perm_delete, pk=G('content'))
+        self.assertEqual(len(p.get_leaves()), 3)
+
+        # The leaves are on the same model, so a single query for all of them
+        with self.assertNumQueries(1):
+            self.assertTrue(call(p, self.content1.pk, self.content2.pk))
+        with self.assertNumQueries(1):
+            self.assertFalse(call(p, self.content2.pk, self.content2.pk))
+        self.assertTrue(call(p, self.content2.pk, self.content1.pk))
+        self.assertFalse(call(p, -1, -1))
+
+        # Leaves on other models are denied rather than looked up by trust
+        p_other = P('auth.change_permission', pk=K('pk')) | P(perm_delete, pk=G('content'))
+        self.assertFalse(call(p_other, self.perm_change.pk, self.content2.pk))
+        self.assertTrue(call(p_other, self.perm_change.pk, self.content1.pk))
+
+        with self.assertRaises(PermissionDenied):
+            self.request.GET = {'content': self.content2.pk}
+            permission_required(p, single_query=True)(Mock())(self.request, pk=self.content2.pk)
+        with self.assertRaises(Http404):
+            permission_required(P(perm_change), single_query=True)(Mock())(self.request)
+
     def test_P_K(self):
         p = P(self.get_perm_code(self.perm_change), pk=K('pk'))
         has_perms = Mock(return_value=False)
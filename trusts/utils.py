@@ -1,9 +1,55 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import threading
+from collections import deque
+from functools import wraps
+
 import six
 from django.db.models import Model
 
+
+def memoize(maxsize=1024):
+    """
+    Decorator memoizing the results of a function of hashable arguments, up
+    to ``maxsize`` entries evicted oldest first. A hit is a single dict
+    lookup, as reordering entries on each hit would cost more than most
+    functions worth memoizing. The undecorated function is kept as
+    ``__wrapped__``.
+    """
+
+    def decorator(func):
+        cache = {}
+        order = deque()
+        lock = threading.Lock()
+
+        @wraps(func)
+        def wrapper(*args):
+            try:
+                return cache[args]
+            except KeyError:
+                pass
+
+            value = func(*args)
+            with lock:
+                if args not in cache:
+                    cache[args] = value
+                    order.append(args)
+                    if len(order) > maxsize:
+                        del cache[order.popleft()]
+            return value
+
+        def cache_clear():
+            with lock:
+                cache.clear()
+                order.clear()
+
+        wrapper.__wrapped__ = func
+        wrapper.cache_clear = cache_clear
+        return wrapper
+    return decorator
+
+
 def get_short_model_name_lower(klass):
     if isinstance(klass, six.string_types):
         return klass.lower()
@@ -18,6 +64,7 @@ def get_short_model_name(klass):
         return '%s.%s' % (klass._meta.app_label, klass._meta.object_name)
     return ''
 
+@memoize(maxsize=1024)
 def parse_perm_code(perm):
     applabel, action_modelname_permcode = perm.split('.', 1)
     action, modelname_permcode = action_modelname_permcode.rsplit('_', 1)